@@ -0,0 +1,330 @@
+""" Benchmarks for the hot paths of nested forms.
+
+	Every benchmark builds a Block tree with the given number of children
+	per level (the widths, e.g. (10, 5, 2) for 10 buildings with 5 tenants
+	with 2 pieces of furniture each; fewer widths make a shallower tree)
+	and times one operation on it:
+	- construct: building a BlockForm for the block
+	- render_form: rendering {% nested_form %}
+	- render_js: rendering {% nested_form_js %}
+	- validate: is_valid() on a submitted form
+	- save: save() on a submitted form that renamed every row
+	- save_bulk: the same save with bulk=True
+	- load: loading the tree with get_hierarchy, one level after the other
+	- load_threads: loading it with load_trees, every level on a thread
+	  of its own (the same as load on databases threads can't share)
+
+	Each result has the wall times of the runs, the queries the operation
+	ran and its peak memory use (measured on an extra run, with
+	tracemalloc). tracemalloc only comes with Python 3.4 and up, on older
+	versions peak_memory is None and peak_memory_unavailable says why.
+	See the benchmark_forms command.
+
+	run_client_benchmark measures how many edit pages a number of
+	concurrent clients get through per second, with the levels loaded one
+	after the other and at the same time.
+
+	run_rewrite_benchmark compares the single pass rewrite of the Dust
+	templates of the form_templates command with the chain of re.sub it
+	replaced.
+"""
+import gc
+import re
+import sys
+import threading
+import time
+import timeit
+
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.template import Context, Template
+from django.test.client import Client
+from django.test.utils import override_settings
+
+from nest.forms import BlockForm
+from nest.listing import can_share_database, get_hierarchy, load_trees
+from nest.models import Block, Building, Tenant, Furniture
+
+try:
+	import tracemalloc
+except ImportError: # Python 2
+	tracemalloc = None
+
+""" Why the results have no peak memory on Pythons without tracemalloc
+"""
+MEMORY_UNAVAILABLE = ("tracemalloc is not available on Python %s, peak "
+	"memory is not measured" % ".".join(str(v) for v in sys.version_info[:3]))
+
+timer = getattr(time, "perf_counter", time.time)
+
+
+""" The models on every level below the block and the fk to their parent
+"""
+LEVELS = (
+	(Building, "block"),
+	(Tenant, "building"),
+	(Furniture, "tenant"),
+)
+
+
+class QueryCounter(object):
+	""" Counts the queries run on a connection while the block runs.
+	"""
+
+	def __init__(self, using=DEFAULT_DB_ALIAS):
+		self.connection = connections[using]
+		self.count = 0
+
+	def __enter__(self):
+		connection = self.connection
+		self.use_debug_cursor = getattr(connection, "use_debug_cursor", None)
+		self.force_debug_cursor = getattr(connection, "force_debug_cursor", None)
+		connection.use_debug_cursor = True
+		connection.force_debug_cursor = True
+		self.start = len(connection.queries)
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		connection = self.connection
+		self.count = len(connection.queries) - self.start
+		connection.use_debug_cursor = self.use_debug_cursor
+		connection.force_debug_cursor = self.force_debug_cursor
+
+
+def create_tree(widths):
+	""" Creates a block with widths[i] children per row on level i and
+		returns it.
+	"""
+	block = Block.objects.create(name="Block")
+	parents = [block]
+	for width, (model, fk_name) in zip(widths, LEVELS):
+		rows = []
+		for parent in parents:
+			for i in range(width):
+				row = model(**{fk_name: parent})
+				if model is Tenant:
+					row.first_name = "Tenant %s" % i
+					row.last_name = "Row %s" % parent.pk
+				else:
+					row.name = "%s %s" % (model.__name__, i)
+				rows.append(row)
+		model.objects.bulk_create(rows)
+		# bulk_create doesn't fill in the primary keys everywhere
+		parents = list(model.objects.filter(**{
+			"%s__in" % fk_name: [parent.pk for parent in parents]}))
+	return block
+
+def get_form_data(form):
+	""" Returns the POST data that submits the given unbound nested form
+		as it is (the tests use it too).
+	"""
+	data = {}
+	for name, field in form.fields.items():
+		value = form.initial.get(name, field.initial)
+		if value is None or value is False or name == "delete_button":
+			continue
+		data[form.add_prefix(name)] = "%s" % value
+	formset = getattr(form, "inline_form", None)
+	if formset is not None:
+		management_form = formset.management_form
+		for name in management_form.fields:
+			data[management_form.add_prefix(name)] = "%s" % (
+				management_form.initial.get(name, 1000))
+		for child in formset.forms:
+			data.update(get_form_data(child))
+	return data
+
+def get_renamed_data(block):
+	""" Returns the POST data for the block's form which renames all rows
+	"""
+	data = get_form_data(BlockForm(instance=block))
+	for name in data:
+		if name.endswith("name"):
+			data[name] += " (renamed)"
+	return data
+
+
+FORM_TEMPLATE = Template("{% load nested_crispy %}{% nested_form form %}")
+JS_TEMPLATE = Template("{% load nested_crispy %}{% nested_form_js form %}")
+
+def render(template, form):
+	return template.render(Context({"form": form, "csrf_token": "benchmark"}))
+
+def get_bound_form(data, block):
+	return BlockForm(data, instance=block)
+
+def validated(form):
+	form.is_valid()
+	return form
+
+""" name: (setup(block), run(setup result))
+"""
+BENCHMARKS = (
+	("construct", lambda block: block,
+		lambda block: BlockForm(instance=block)),
+	("render_form", lambda block: BlockForm(instance=block),
+		lambda form: render(FORM_TEMPLATE, form)),
+	("render_js", lambda block: BlockForm(instance=block),
+		lambda form: render(JS_TEMPLATE, form)),
+	("validate", lambda block: get_bound_form(get_form_data(
+			BlockForm(instance=block)), block),
+		lambda form: form.is_valid()),
+	("save", lambda block: validated(get_bound_form(
+			get_renamed_data(block), block)),
+		lambda form: form.save()),
+	("save_bulk", lambda block: validated(get_bound_form(
+			get_renamed_data(block), block)),
+		lambda form: form.save(bulk=True)),
+	("load", lambda block: Block.objects.filter(pk=block.pk),
+		lambda queryset: get_hierarchy(BlockForm, queryset)),
+	("load_threads", lambda block: Block.objects.filter(pk=block.pk),
+		lambda queryset: load_trees(BlockForm, list(queryset),
+			threads=len(LEVELS))),
+)
+
+
+def run_once(setup, run, widths, using, trace_memory=False):
+	""" Runs one benchmark on a brand new tree and returns its wall time,
+		query count and peak memory (or None).
+	"""
+	block = create_tree(widths)
+	try:
+		argument = setup(block)
+		gc.collect()
+		peak_memory = None
+		if trace_memory:
+			tracemalloc.start()
+		with QueryCounter(using) as queries:
+			start = timer()
+			run(argument)
+			wall_time = timer() - start
+		if trace_memory:
+			peak_memory = tracemalloc.get_traced_memory()[1]
+			tracemalloc.stop()
+	finally:
+		block.delete()
+	return wall_time, queries.count, peak_memory
+
+def run_benchmarks(widths=(10, 5, 2), repeat=3, names=None,
+		using=DEFAULT_DB_ALIAS):
+	""" Runs the benchmarks (all of them unless names are given) repeat
+		times on a tree of the given widths and returns their results.
+	"""
+	widths = tuple(widths)[:len(LEVELS)]
+	rows = 1
+	row_count = 1
+	for width in widths:
+		rows *= width
+		row_count += rows
+	results = []
+	for name, setup, run in BENCHMARKS:
+		if names and name not in names:
+			continue
+		wall_times = []
+		for i in range(max(repeat, 1)):
+			wall_time, queries, peak_memory = run_once(setup, run, widths,
+				using)
+			wall_times.append(wall_time)
+		if tracemalloc is not None:
+			peak_memory = run_once(setup, run, widths, using,
+				trace_memory=True)[2]
+		result = {
+			"name": name,
+			"widths": list(widths),
+			"rows": row_count,
+			"wall_times": wall_times,
+			"best_wall_time": min(wall_times),
+			"queries": queries,
+			"peak_memory": peak_memory,
+		}
+		if tracemalloc is None:
+			result["peak_memory_unavailable"] = MEMORY_UNAVAILABLE
+		results.append(result)
+	return results
+
+
+def run_client_benchmark(widths=(10, 5, 2), clients=4, requests=20,
+		using=DEFAULT_DB_ALIAS):
+	""" Has the given number of clients, each on a thread of its own, get
+		the edit page of a block requests times, first with the levels of
+		the tree loaded one after the other and then at the same time (see
+		load_trees), and returns the requests per second of both.
+		Only databases that all the threads see can be used, so this is
+		skipped on in-memory SQLite databases.
+	"""
+	results = {"name": "edit_page_clients", "widths": list(widths),
+		"clients": clients, "requests": requests}
+	if not can_share_database(using):
+		results["skipped"] = "%s is an in-memory database" % using
+		return results
+	block = create_tree(tuple(widths)[:len(LEVELS)])
+	url = "/edit/block/%s/" % block.pk
+
+	def get_pages():
+		client = Client()
+		for i in range(requests):
+			client.get(url)
+		connections[using].close()
+
+	try:
+		for name, threads in (("sequential", 0), ("threads", len(LEVELS))):
+			with override_settings(NEST_LOADER_THREADS=threads):
+				workers = [threading.Thread(target=get_pages)
+					for i in range(clients)]
+				start = timer()
+				for worker in workers:
+					worker.start()
+				for worker in workers:
+					worker.join()
+				wall_time = timer() - start
+			results["%s_wall_time" % name] = wall_time
+			results["%s_requests_per_second" % name] = \
+				clients * requests / wall_time
+	finally:
+		block.delete()
+	return results
+
+
+def rewrite_template_chain(html, prefix):
+	""" The way form_templates used to rewrite its templates, one re.sub
+		at a time. See rewrite_template.
+	"""
+	html = html.strip().replace("\n","").replace("\t","")
+	html = re.sub(r'="div_id_(\w+)"',  r'="div_id_%s-{index}-\1"' % prefix, html)
+	html = re.sub(r'="id_(\w+)"',  r'="id_%s-{index}-\1"' % prefix, html)
+	html = re.sub(r'name="([\w_]+)"', r'name="%s-{index}-\1"' % prefix, html)
+	html = re.sub(r'(\t)+', '', html.strip())
+	return html
+
+def run_rewrite_benchmark(repeat=3, number=200):
+	""" Times rewrite_template against rewrite_template_chain on the
+		templates of all the child forms of the installed apps. The times
+		are for rewriting every template number times.
+	"""
+	from django.conf import settings
+	from nest.management.commands.form_templates import (find_child_forms,
+		render_raw_template, rewrite_template)
+
+	modules = []
+	for app in settings.INSTALLED_APPS:
+		try:
+			__import__("%s.forms" % app)
+			modules.append(sys.modules["%s.forms" % app])
+		except ImportError:
+			pass
+	templates = [render_raw_template(item)[1:]
+		for item in find_child_forms(modules)]
+
+	def run(rewrite):
+		return lambda: [rewrite(html, prefix) for prefix, html in templates]
+
+	results = {"name": "rewrite_templates", "templates": len(templates),
+		"number": number}
+	for name, rewrite in (("chain", rewrite_template_chain),
+			("single_pass", rewrite_template)):
+		wall_times = timeit.repeat(run(rewrite), repeat=max(repeat, 1),
+			number=number)
+		results["%s_wall_times" % name] = wall_times
+		results["%s_best_wall_time" % name] = min(wall_times)
+	results["identical"] = run(rewrite_template)() == \
+		run(rewrite_template_chain)()
+	return results
@@ -0,0 +1,266 @@
+""" Bulk saving for nested forms.
+
+	Saving a validated NestedModelForm normally saves every row one by one,
+	recursing level by level. BulkSaver walks the whole validated tree one
+	level at a time instead and, for each level:
+	- deletes the rows flagged with DELETE using one query per model
+	- updates the changed rows, grouping rows that got the same values
+	- creates the new rows with bulk_create
+
+	Parents are always saved before their children so the foreign keys can
+	be filled in level by level. Everything runs in one transaction.
+
+	Note that rows saved this way don't go through Model.save() so
+	pre_save/post_save signals are not sent, and many to many data is not
+	saved.
+
+	delete_trees does the same for deleting whole trees of rows: one DELETE
+	per level, bottom up, instead of Django's collector fetching and
+	deleting every row on its own. Levels the collector has work to do for
+	(rows other models point at, delete signals) are still deleted through
+	it, see can_raw_delete.
+"""
+from django.db import connections, router, transaction
+from django.db.models import DO_NOTHING, signals
+
+
+def atomic(using=None):
+	""" Returns a transaction context manager for the given database
+		(transaction.atomic where it is available).
+	"""
+	if hasattr(transaction, "atomic"):
+		return transaction.atomic(using=using)
+	return transaction.commit_on_success(using=using)
+
+def chunks(items, size):
+	""" Splits the items into lists of at most size items.
+	"""
+	for i in range(0, len(items), size):
+		yield items[i:i + size]
+
+def get_model_label(model):
+	return "%s.%s" % (model._meta.app_label, model._meta.object_name)
+
+
+class BulkSaver(object):
+	""" Saves a validated nested form and all of its inline forms using as
+		few queries as possible. The counts of the rows created, updated
+		and deleted per model are kept in `counts`.
+	"""
+
+	def __init__(self, form, batch_size=500):
+		self.form = form
+		self.batch_size = batch_size
+		self.using = router.db_for_write(form._meta.model,
+			instance=form.instance)
+		self.counts = {"created": {}, "updated": {}, "deleted": {}}
+
+	def save(self):
+		with atomic(using=self.using):
+			instance = self.form.save(commit=True, save_formset=False)
+			level = []
+			if getattr(self.form, "inline_form", None) is not None:
+				level.append((self.form.inline_form, instance))
+			while level:
+				level = self.save_level(level)
+		return instance
+
+	def save_level(self, level):
+		""" Saves all the rows of the given list of (formset, parent)
+			and returns the (formset, parent) list for the next level.
+		"""
+		creates = {}
+		updates = {}
+		deletes = {}
+		next_level = []
+		for formset, parent in level:
+			fk = formset.fk
+			initial_form_count = formset.initial_form_count()
+			for i, form in enumerate(formset.forms):
+				is_initial = i < initial_form_count
+				if not is_initial and not form.has_changed():
+					continue
+				obj = form.instance
+				if formset.can_delete and formset._should_delete_form(form):
+					if is_initial and obj.pk is not None:
+						deletes.setdefault(formset.model, []).append(obj.pk)
+					continue
+				setattr(obj, fk.name, parent)
+				children = getattr(form, "inline_form", None)
+				if not is_initial:
+					creates.setdefault(formset.model, []).append(
+						(obj, children is not None and
+							self.has_new_rows(children)))
+				elif form.has_changed():
+					fields = self.get_changed_fields(form)
+					if fields:
+						updates.setdefault(formset.model, []).append(
+							(obj, fields))
+				if children is not None:
+					next_level.append((children, obj))
+
+		for model, pks in deletes.items():
+			self.delete(model, pks)
+		for model, rows in updates.items():
+			self.update(model, rows)
+		for model, rows in creates.items():
+			self.create(model, rows)
+		return next_level
+
+	@staticmethod
+	def has_new_rows(formset):
+		return any(form.has_changed() for form in formset.extra_forms)
+
+	@staticmethod
+	def get_changed_fields(form):
+		""" Returns the model fields that were changed on the form
+		"""
+		opts = form.instance._meta
+		field_names = set(field.name for field in opts.fields
+			if not field.primary_key)
+		return [opts.get_field(name) for name in form.changed_data
+			if name in field_names]
+
+	def count(self, action, model, count):
+		counts = self.counts[action]
+		label = get_model_label(model)
+		counts[label] = counts.get(label, 0) + count
+
+	def delete(self, model, pks):
+		manager = model._default_manager.db_manager(self.using)
+		for batch in chunks(pks, self.batch_size):
+			manager.filter(pk__in=batch).delete()
+		self.count("deleted", model, len(pks))
+
+	def update(self, model, rows):
+		""" Updates the given (obj, changed fields) rows. Rows which got
+			the exact same values are updated together.
+		"""
+		manager = model._default_manager.db_manager(self.using)
+		grouped = {}
+		for obj, fields in rows:
+			values = dict((field.name, getattr(obj, field.name))
+				for field in fields)
+			try:
+				key = tuple(sorted(values.items()))
+			except TypeError: # unhashable values get an UPDATE of their own
+				manager.filter(pk=obj.pk).update(**values)
+				continue
+			grouped.setdefault(key, []).append(obj.pk)
+		for key, pks in grouped.items():
+			for batch in chunks(pks, self.batch_size):
+				manager.filter(pk__in=batch).update(**dict(key))
+		self.count("updated", model, len(rows))
+
+	def create(self, model, rows):
+		""" Creates the given (obj, needs pk) rows. Rows whose children still
+			need to be created must come back with their primary key; only
+			some backends fill that in on bulk_create so on the others
+			those rows are saved one at a time.
+		"""
+		features = connections[self.using].features
+		returns_ids = getattr(features, "can_return_ids_from_bulk_insert",
+			False) or getattr(features, "can_return_rows_from_bulk_insert",
+			False)
+		objs = []
+		for obj, needs_pk in rows:
+			if needs_pk and not returns_ids:
+				obj.save(using=self.using, force_insert=True)
+			else:
+				objs.append(obj)
+		manager = model._default_manager.db_manager(self.using)
+		for batch in chunks(objs, self.batch_size):
+			manager.bulk_create(batch)
+		self.count("created", model, len(rows))
+
+
+def bulk_save(form, batch_size=500):
+	""" Saves the given validated nested form in bulk (see BulkSaver) and
+		returns the saved instance.
+	"""
+	saver = BulkSaver(form, batch_size=batch_size)
+	instance = saver.save()
+	form.save_counts = saver.counts
+	return instance
+
+
+def can_raw_delete(model, child_fk=None):
+	""" Returns whether the rows of the given model can go with a raw
+		DELETE, the same checks as Collector.can_fast_delete except for
+		child_fk: the foreign key of the children in the nested forms,
+		which delete_trees has deleted already. Anything else pointing at
+		the rows (other models, generic relations, models added later) or
+		listening to their deletion needs the collector.
+	"""
+	if (signals.pre_delete.has_listeners(model) or
+			signals.post_delete.has_listeners(model) or
+			signals.m2m_changed.has_listeners(model)):
+		return False
+	opts = model._meta
+	if opts.concrete_model._meta.parents:
+		return False
+	for related in opts.get_all_related_objects(include_hidden=True,
+			include_proxy_eq=True):
+		if related.field is not child_fk and \
+				related.field.rel.on_delete is not DO_NOTHING:
+			return False
+	for relation in opts.many_to_many:
+		if not relation.rel.through:
+			return False
+	return True
+
+def delete_trees(form_class, pks, detach=False, using=None, batch_size=500):
+	""" Deletes the rows of the model of the given nested form class with
+		the given pks along with their whole trees of children (as declared
+		on the form classes, see get_schema). Every level is deleted with
+		one set-based DELETE (per batch of batch_size roots), the deepest
+		level first, all in one transaction.
+		With detach the children of the rows are kept and their foreign
+		key is cleared (one UPDATE) instead.
+		Like bulk saving this skips Model.delete(). Levels that
+		can_raw_delete turns down are deleted with QuerySet.delete(), which
+		sends the signals and cascades to the rows of other models.
+		Returns the counts of the rows deleted and detached per model.
+	"""
+	from nest.forms import get_schema
+
+	schema = get_schema(form_class)
+	if detach:
+		schema = schema[:2]
+	if using is None:
+		using = router.db_for_write(schema[0].model)
+	counts = {"deleted": {}, "detached": {}}
+
+	def count(action, model, n):
+		label = get_model_label(model)
+		counts[action][label] = counts[action].get(label, 0) + n
+
+	# The children of every level are gone (or detached) by the time it is
+	# deleted, anything else pointing at it needs the collector
+	raw_levels = [can_raw_delete(level.model, level.child.formset_class.fk
+			if level.child is not None else None)
+		for level in schema]
+	pks = list(pks)
+	with atomic(using=using):
+		for batch in chunks(pks, batch_size):
+			# The rows of every level as a subquery on the level above
+			querysets = [schema[0].model._default_manager.db_manager(
+				using).filter(pk__in=batch)]
+			for level in schema[1:]:
+				fk = level.formset_class.fk
+				querysets.append(level.model._default_manager.db_manager(
+					using).filter(**{"%s__in" % fk.name:
+						querysets[-1].values("pk")}))
+			if detach and len(schema) > 1:
+				fk = schema[1].formset_class.fk
+				count("detached", schema[1].model,
+					querysets.pop().update(**{fk.name: None}))
+			for level, queryset, raw in reversed(list(zip(schema, querysets,
+					raw_levels))):
+				n = queryset.count()
+				if n and raw:
+					queryset._raw_delete(using=using)
+				elif n:
+					queryset.delete()
+				count("deleted", level.model, n)
+	return counts
@@ -0,0 +1,125 @@
+""" A static bundle of the knockout <script> templates of nested forms.
+
+	The form_templates command writes all the templates of all the nested
+	forms into one minified JS file, named after a hash of its content, and
+	a manifest describing it. With NEST_TEMPLATE_BUNDLE pointing at the
+	manifest, the nested_form tag loads that file (which browsers cache
+	across pages) instead of printing the templates into every page. Forms
+	whose templates aren't in the bundle, or changed since it was built,
+	still get their templates printed.
+"""
+import hashlib
+import json
+import os
+import re
+
+from django.conf import settings
+from django.template import Context
+
+MANIFEST_NAME = "nest-templates.json"
+
+""" Adds the templates to the page as <script type="text/html"> elements,
+	where knockout looks for them.
+"""
+BUNDLE_JS = ('(function(){var t=%s,h=document.getElementsByTagName("head")[0];'
+	'for(var i in t){if(!document.getElementById(i)){'
+	'var s=document.createElement("script");s.type="text/html";s.id=i;'
+	's.text=t[i];h.appendChild(s);}}})();\n')
+
+_manifests = {}
+
+
+def get_class_path(cls):
+	return "%s.%s" % (cls.__module__, cls.__name__)
+
+def minify(html):
+	""" Collapses the runs of white space in the templates (there are no
+		<pre> or filled in <textarea> in a template of an unbound form).
+	"""
+	return re.sub(r"\s+", " ", html).strip()
+
+def build_bundle(form_classes=None):
+	""" Renders the templates of the given nested form classes (all of the
+		ones with children by default) and returns the JS of the bundle and
+		the fingerprints of the form classes it was built from.
+	"""
+	from nest.forms import get_nested_form_classes
+	from nest.templatetags.nested_crispy import (build_form_templates,
+		get_form_templates_fingerprint)
+
+	if form_classes is None:
+		form_classes = [form_class for form_class in get_nested_form_classes()
+			if form_class.child_form_class is not None]
+	templates = {}
+	fingerprints = {}
+	for form_class in form_classes:
+		form = form_class()
+		fingerprints[get_class_path(form_class)] = \
+			get_form_templates_fingerprint(form)
+		# No csrf_token in here, the page's own form has the token
+		for template_name, html in build_form_templates(form, Context()):
+			opening = '<script type="text/html" id="%s">' % template_name
+			content = html[len(opening):-len("</script>")]
+			templates.setdefault(template_name, minify(content))
+	js = BUNDLE_JS % json.dumps(templates, sort_keys=True,
+		separators=(",", ":"))
+	return js, fingerprints, sorted(templates)
+
+def write_bundle(static_dir, form_classes=None):
+	""" Writes the bundle to js/nest-templates.<hash>.js under the given
+		static directory along with its manifest, js/nest-templates.json.
+		Returns the path of the bundle and whether it was written (it isn't
+		when a bundle with the same content is already there).
+	"""
+	from nest.templatetags.nested_crispy import get_template_pack
+
+	js, fingerprints, template_names = build_bundle(form_classes)
+	content = js.encode("utf-8")
+	name = "js/nest-templates.%s.js" % hashlib.sha1(content).hexdigest()[:12]
+	js_dir = os.path.join(static_dir, "js")
+	if not os.path.exists(js_dir):
+		os.makedirs(js_dir)
+	filename = os.path.join(static_dir, name)
+	written = not os.path.exists(filename)
+	if written:
+		with open(filename, "wb") as f:
+			f.write(content)
+	manifest = json.dumps({
+		"file": name,
+		"forms": fingerprints,
+		"templates": template_names,
+		"template_pack": get_template_pack(),
+	}, indent=2, sort_keys=True)
+	manifest_filename = os.path.join(js_dir, MANIFEST_NAME)
+	current = None
+	if os.path.exists(manifest_filename):
+		with open(manifest_filename) as f:
+			current = f.read()
+	if current != manifest:
+		with open(manifest_filename, "w") as f:
+			f.write(manifest)
+	return filename, written
+
+def get_bundle():
+	""" Returns the manifest NEST_TEMPLATE_BUNDLE points to, or None when
+		the setting isn't set or there is no bundle yet. The manifest is
+		read again whenever the file changes (e.g. the form_templates
+		command ran after the process started).
+	"""
+	path = getattr(settings, "NEST_TEMPLATE_BUNDLE", None)
+	if not path:
+		return None
+	try:
+		mtime = os.path.getmtime(path)
+	except OSError:
+		return None
+	cached = _manifests.get(path)
+	if cached is None or cached[0] != mtime:
+		try:
+			with open(path) as f:
+				manifest = json.load(f)
+		except (IOError, OSError, ValueError):
+			# Half written or broken, try again next time
+			return None
+		cached = _manifests[path] = (mtime, manifest)
+	return cached[1]
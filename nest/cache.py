@@ -0,0 +1,134 @@
+""" Caching helpers used when rendering nested forms.
+"""
+import hashlib
+import inspect
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from django.core.cache import cache
+from django.utils.encoding import force_text
+
+
+""" Placeholder the CSRF token is swapped out for in cached HTML so that
+	one user's token never ends up on another user's page.
+"""
+CSRF_TOKEN_PLACEHOLDER = "__NEST_CSRF_TOKEN__"
+
+
+class LRUCache(object):
+	""" A small thread safe, in-process, least recently used cache.
+		A max_size of 0 disables the cache.
+	"""
+
+	def __init__(self, max_size=128):
+		self.max_size = max_size
+		self._data = OrderedDict()
+		self._lock = threading.Lock()
+
+	def get(self, key, default=None):
+		with self._lock:
+			try:
+				value = self._data.pop(key)
+			except KeyError:
+				return default
+			self._data[key] = value # mark it as the most recently used
+			return value
+
+	def set(self, key, value):
+		if not self.max_size:
+			return
+		with self._lock:
+			self._data.pop(key, None)
+			self._data[key] = value
+			while len(self._data) > self.max_size:
+				self._data.popitem(last=False)
+
+	def clear(self):
+		with self._lock:
+			self._data.clear()
+
+	def __len__(self):
+		return len(self._data)
+
+
+def get_class_fingerprint(cls):
+	""" Returns a string that changes whenever the definition of the given
+		(form) class changes: its source and the fields it declares.
+	"""
+	try:
+		source = inspect.getsource(cls)
+	except (IOError, TypeError):
+		source = ""
+	fields = []
+	for name, field in getattr(cls, "base_fields", {}).items():
+		fields.append("%s:%s:%s:%s:%s" % (name, field.__class__.__name__,
+			field.widget.__class__.__name__, field.required,
+			force_text(field.label)))
+	return "%s.%s|%s|%s" % (cls.__module__, cls.__name__, source,
+		"|".join(sorted(fields)))
+
+def get_fingerprint(*classes):
+	""" Returns a short hash of the definitions of the given classes.
+	"""
+	fingerprint = hashlib.sha1()
+	for cls in classes:
+		if cls is not None:
+			fingerprint.update(get_class_fingerprint(cls).encode("utf-8"))
+	return fingerprint.hexdigest()
+
+@contextmanager
+def csrf_token_placeholder(context):
+	""" Renders with the placeholder standing in for the CSRF token of the
+		given context (if it has one), so that what gets rendered can be
+		cached and shared, see restore_csrf_token.
+	"""
+	if not context.get("csrf_token"):
+		yield
+		return
+	context.push()
+	context["csrf_token"] = CSRF_TOKEN_PLACEHOLDER
+	try:
+		yield
+	finally:
+		context.pop()
+
+def restore_csrf_token(html, token):
+	""" Puts the given CSRF token in html rendered with
+		csrf_token_placeholder.
+	"""
+	return html.replace(CSRF_TOKEN_PLACEHOLDER, force_text(token or ""))
+
+def get_version_key(model, pk):
+	return "nest-version:%s.%s:%s" % (model._meta.app_label,
+		model._meta.object_name, pk)
+
+def new_version():
+	""" Versions start out at the current time (in ms) so that a version
+		that was evicted from the cache never comes back as an older one.
+	"""
+	return int(time.time() * 1000)
+
+def get_versions(rows):
+	""" Returns the versions of the given (model, pk) rows, kept in the
+		Django cache. See bump_versions.
+	"""
+	keys = [get_version_key(model, pk) for model, pk in rows]
+	versions = cache.get_many(keys)
+	for key in keys:
+		if key not in versions:
+			cache.add(key, new_version())
+			versions[key] = cache.get(key)
+	return [versions[key] for key in keys]
+
+def bump_versions(rows):
+	""" Changes the versions of the given (model, pk) rows, which throws
+		out everything that was cached for them under the old versions.
+	"""
+	for model, pk in rows:
+		key = get_version_key(model, pk)
+		try:
+			cache.incr(key)
+		except ValueError: # not in the cache (any more)
+			cache.set(key, new_version())
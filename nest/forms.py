@@ -1,4 +1,5 @@
 import inspect
+import logging
 import re
 
 from django.forms import ModelForm, Form, HiddenInput
@@ -8,18 +9,28 @@ from django.forms.models import (
 	BaseInlineFormSet
 )
 from django import forms
+from django.conf import settings
 from django.utils import html
+from django.utils.datastructures import MultiValueDict
 
 from crispy_forms.helper import FormHelper
 from crispy_forms.layout import Submit, Button
 
+from nest import tracing
+from nest.bulk import bulk_save, get_model_label
+from nest.cache import bump_versions
 from nest.models import Building, Block, Tenant, Furniture
 
+logger = logging.getLogger(__name__)
 
 class SubmitButtonWidget(forms.Widget):
     def render(self, name, value, attrs=None):
         return '<input type="button" name="%s" value="%s" onclick="deleteChild(this);">' % (html.escape(name), html.escape(value))
 
+    def _has_changed(self, initial, data):
+        # Buttons are never submitted, that doesn't make the form changed
+        return False
+
 class SubmitButtonField(forms.Field):
     def __init__(self, *args, **kwargs):
         if not kwargs:
@@ -31,47 +42,135 @@ class SubmitButtonField(forms.Field):
     def clean(self, value):
         return value
 
+    def _has_changed(self, initial, data):
+        return False
+    has_changed = _has_changed
+
 def to_underscore_case(name):
 	""" Converts title case to underscore case
 	"""
 	s1 = re.sub('(.)([A-Z][a-z]+)', r'\1_\2', name)
 	return re.sub('([a-z0-9])([A-Z])', r'\1_\2', s1).lower()
 
+def tree_has_changed(form):
+	""" Returns whether the given form or any of the forms nested in it
+		were changed (rows flagged with DELETE count as changed).
+	"""
+	if not hasattr(form, "_tree_changed"):
+		formset = getattr(form, "inline_form", None)
+		form._tree_changed = form.has_changed() or (formset is not None and
+			any(tree_has_changed(child) for child in formset.forms))
+	return form._tree_changed
+
 
 
 class NestedModelForm(ModelForm):
 
+	# The form of the children (and the form with the actions on them),
+	# they can be given to the constructor as well. Declaring them on the
+	# class lets tools find the whole tree without instantiating any form.
+	child_form_class = None
+	child_actions_form_class = None
+
 	def __init__(self, *args, **kwargs):
-		child_form = kwargs.pop("child_form", None)
-		child_actions_form = kwargs.pop("child_actions_form", None)
-		super(NestedModelForm, self).__init__(*args, **kwargs)
-		if not self.prefix:
-			self.prefix = ""
-		self.setup_nested_form(child_form, child_actions_form)
+		child_form = kwargs.pop("child_form", None) or self.child_form_class
+		child_actions_form = kwargs.pop("child_actions_form", None) or \
+			self.child_actions_form_class
+		# Only show the first child_limit children on every level of an
+		# unbound form, starting at child_offset for our own children.
+		self.child_limit = kwargs.pop("child_limit",
+			getattr(settings, "NEST_CHILD_LIMIT", None))
+		self.child_offset = kwargs.pop("child_offset", 0)
+		# A JSON submission of the whole tree, see get_json_form_data
+		json_data = kwargs.pop("json_data", None)
+		if json_data is not None:
+			kwargs["data"] = get_json_form_data(self.__class__, json_data,
+				kwargs.get("prefix") or "", child_form, child_actions_form)
+		# The data of the whole tree split up by formset, see DataIndex
+		self.data_index = kwargs.pop("data_index", None)
+		with tracing.span("construct", self) as span:
+			super(NestedModelForm, self).__init__(*args, **kwargs)
+			if not self.prefix:
+				self.prefix = ""
+			if self.data_index is None and self.is_bound and \
+					DataIndex.is_worth_it(self.data):
+				self.data_index = DataIndex(self.data)
+			self.setup_nested_form(child_form, child_actions_form)
+			if self.inline_form:
+				span.rows = len(self.inline_form.forms)
 
 	def get_uc_form_name(self):
 		""" Returns the underscore cased version
 		"""
 		return to_underscore_case(self.get_form_name())
 
-	def is_valid(self):
-		valid = super(NestedModelForm, self).is_valid()
-		# Check if the inline form is valid
-		if self.inline_form:
-			valid &= self.inline_form.is_valid()
+	def is_valid(self, changed_only=False):
+		""" Validates this form and all of its nested forms. With
+			changed_only, the existing rows that were not changed (and
+			whose children weren't either) are not validated, see
+			BaseNestedFormset.skip_unchanged_forms.
+			The formsets validate their forms again without any arguments
+			(see BaseModelFormSet.validate_unique) so nested forms take the
+			mode of their formset.
+		"""
+		parent_formset = getattr(self, "parent_formset", None)
+		changed_only = changed_only or \
+			getattr(parent_formset, "_changed_only", False)
+		with tracing.span("validate", self) as span:
+			valid = super(NestedModelForm, self).is_valid()
+			# Check if the inline form is valid, unchanged subtrees are left
+			# alone
+			if self.inline_form and not (changed_only and
+					parent_formset is not None and not tree_has_changed(self)):
+				valid &= self.inline_form.is_valid(changed_only=changed_only)
+				span.rows = len(self.inline_form.forms)
+		if self.is_root() and logger.isEnabledFor(logging.DEBUG):
+			logger.debug("%s is %s", self.__class__.__name__,
+				"valid" if valid else "invalid", extra={"nest_form":
+					self.__class__.__name__, "nest_valid": bool(valid)})
 		return valid
 
-	def save(self, commit=True, save_formset=True):
-		result = super(NestedModelForm, self).save(commit=commit)
-
-		if self.inline_form:
-			if save_formset:
-				print("Saving inline form: %s" % self.inline_form.__class__.__name__)
-				print(" will also save %s nested forms" % len(self.inline_form.forms))
-				self.inline_form.save(commit=commit)
+	def is_root(self):
+		""" Returns whether this is the top level form, as opposed to one
+			of the forms of a nested formset.
+		"""
+		return getattr(self, "parent_formset", None) is None
+
+	def save(self, commit=True, save_formset=True, bulk=False,
+			changed_only=False):
+		""" Saves this form and (unless save_formset is False) all of its
+			nested forms. Pass bulk=True to save the whole tree with a
+			handful of queries per level instead of row by row, see
+			nest.bulk.BulkSaver. With changed_only, the unchanged parts of
+			the tree are skipped altogether.
+		"""
+		with tracing.span("save", self) as span:
+			if bulk and commit and save_formset:
+				result = bulk_save(self)
 			else:
-				print("NOT saving formset: %s" % self.inline_form.__class__.__name__)
-				print(self.inline_form.cleaned_data)
+				result = self.save_tree(commit, save_formset, changed_only)
+				if self.inline_form:
+					span.rows = len(self.inline_form.forms)
+				if commit and save_formset and self.is_root():
+					self.save_counts = get_save_counts(self)
+		if commit and save_formset and self.is_root():
+			log_save_counts(self)
+			if getattr(settings, "NEST_FRAGMENT_CACHE", False):
+				# Throw out the cached markup of the tree and its ancestors
+				bump_versions(get_lineage(result))
+		return result
+
+	def save_tree(self, commit, save_formset, changed_only):
+		if (changed_only and commit and self.instance.pk is not None and
+				not self.has_changed()):
+			result = self.instance
+		else:
+			result = super(NestedModelForm, self).save(commit=commit)
+
+		# Without save_formset the caller saves the children (e.g. the
+		# BulkSaver), rows being deleted are skipped by their formset
+		if self.inline_form and save_formset:
+			self.inline_form.save(commit=commit, changed_only=changed_only)
 		return result
 
 	def setup_nested_form(self, child_form, child_actions_form=None):
@@ -97,19 +196,24 @@ class NestedModelForm(ModelForm):
 		self.child_actions_form = child_actions_form
 		self.inline_prefix = None
 		if child_form:
-			InlineFormset = inlineformset_factory(self.parent_model, 
-				self.child_model, extra=0,
-				formset=ManangeFormCachedBaseInlineFormset,
-				form=child_form)
+			InlineFormset = get_inline_formset_class(self.parent_model,
+				self.child_model, child_form)
 			prefix_separator = "-" if self.prefix else ""
+			prefix = "%s%s%s" % (
+				self.prefix,
+				prefix_separator,
+				InlineFormset.get_default_prefix()
+				)
+			data = self.data if self.is_bound else None
+			if self.is_bound and self.data_index is not None:
+				data = self.data_index.get(prefix)
 			self.inline_form = InlineFormset(
 				instance=self.instance,
-				data=self.data if self.is_bound else None,
-				prefix = "%s%s%s" % (
-					self.prefix,
-					prefix_separator,
-					InlineFormset.get_default_prefix()
-					)
+				data=data,
+				prefix=prefix,
+				child_limit=self.child_limit,
+				child_offset=self.child_offset,
+				data_index=self.data_index
 				)
 			self.inline_form.actions_form = child_actions_form
 			self.inline_prefix = InlineFormset.get_default_prefix()
@@ -122,10 +226,6 @@ class NestedModelForm(ModelForm):
 		""" Returns the JS call necessary to add a child to this form of type
 			"child_form" to a given form. Also need to specify the parent_form.
 		"""
-		if inspect.isclass(child_form):
-			child_form = child_form()
-		if inspect.isclass(parent_form):
-			parent_form = parent_form()
 		return "click: addChildForm"
 		# % (child_form.get_form_name(), parent_form.inline_prefix)
 
@@ -149,9 +249,6 @@ class BuildingActionsForm(Form):
 
 class BlockForm(NestedModelForm):
 	def __init__(self, *args, **kwargs):
-		# Set the child form
-		kwargs["child_form"] = BuildingForm
-		kwargs["child_actions_form"] = BuildingActionsForm
 		super(BlockForm, self).__init__(*args, **kwargs)
 		self.helper = FormHelper()
 		self.helper.form_method = 'post'
@@ -164,8 +261,6 @@ class BlockForm(NestedModelForm):
 class BuildingForm(NestedModelForm):
 
 	def __init__(self, *args, **kwargs):
-		kwargs["child_form"] = TenantForm
-		kwargs["child_actions_form"] = TenantActionsForm
 		super(BuildingForm, self).__init__(*args, **kwargs)
 		self.helper = FormHelper()
 		self.helper.form_tag = False
@@ -192,7 +287,6 @@ class TenantActionsForm(Form):
 class TenantForm(NestedModelForm):
 
 	def __init__(self, *args, **kwargs):
-		kwargs["child_form"] = FurnitureForm
 		super(TenantForm, self).__init__(*args, **kwargs)
 		self.helper = FormHelper()
 		self.helper.form_tag = False
@@ -207,13 +301,112 @@ class FurnitureForm(ModelForm):
 	class Meta:
 		model = Furniture
 
+# The tree of the forms above, see NestedModelForm.child_form_class
+BlockForm.child_form_class = BuildingForm
+BlockForm.child_actions_form_class = BuildingActionsForm
+BuildingForm.child_form_class = TenantForm
+BuildingForm.child_actions_form_class = TenantActionsForm
+TenantForm.child_form_class = FurnitureForm
+
 BuildingFormSet = modelformset_factory(Building, form=BuildingForm, extra=0)
 TenantFormSet = modelformset_factory(Tenant, form=TenantForm)
 InlineFormset = inlineformset_factory(Block, Building, extra=0)
 
+class PrefetchedRows(list):
+	""" The prefetched children of a parent row. The model formsets only
+		need to iterate, index and count their queryset (and look at its
+		db) so a list sorted the same way the formset would have ordered
+		the queryset does the job.
+	"""
+
+	def __init__(self, queryset, ordered=False):
+		super(PrefetchedRows, self).__init__(queryset)
+		self.db = queryset.db
+		if not ordered:
+			self.sort(key=lambda row: row.pk)
+
+class ChildWindow(object):
+	""" A page of the children of a parent row, starting at offset.
+		Indexing works with the index of the child among all the children
+		so the model formsets can use it in place of their queryset.
+	"""
+
+	def __init__(self, rows, offset, has_more, db):
+		self.rows = rows
+		self.offset = offset
+		self.has_more = has_more
+		self.db = db
+
+	def __len__(self):
+		return self.offset + len(self.rows)
+
+	def __getitem__(self, index):
+		if index < self.offset:
+			raise IndexError("Child %s is not in this window" % index)
+		return self.rows[index - self.offset]
+
+	def __iter__(self):
+		return iter(self.rows)
+
+class DataIndex(object):
+	""" The submitted data of a nested form split up, in one pass, by the
+		formset the keys belong to, e.g. buildings-0-tenants-1-first_name
+		and buildings-0-tenants-TOTAL_FORMS go to buildings-0-tenants. Every
+		nested formset (and its forms) is then bound to its own slice only
+		instead of to all the data of the request. The keys of the top
+		level form itself aren't in any slice.
+		Only submissions with at least NEST_DATA_INDEX_THRESHOLD keys (1000
+		by default, None turns it off) are worth splitting up.
+	"""
+
+	management_fields = ("TOTAL_FORMS", "INITIAL_FORMS", "MAX_NUM_FORMS",
+		"MIN_NUM_FORMS")
+
+	def __init__(self, data):
+		self.slices = {}
+		if isinstance(data, MultiValueDict):
+			items = data.lists()
+		else:
+			items = [(key, [value]) for key, value in data.items()]
+		for key, values in items:
+			prefix = self.get_formset_prefix(key)
+			if prefix is not None:
+				self.slices.setdefault(prefix, MultiValueDict()).setlist(key,
+					values)
+
+	@classmethod
+	def is_worth_it(cls, data):
+		threshold = getattr(settings, "NEST_DATA_INDEX_THRESHOLD", 1000)
+		return threshold is not None and len(data) >= threshold
+
+	@classmethod
+	def get_formset_prefix(cls, key):
+		""" Returns the prefix of the formset the given key belongs to
+			(prefix-TOTAL_FORMS or prefix-index-field) or None.
+		"""
+		parts = key.rsplit("-", 2)
+		if parts[-1] in cls.management_fields and len(parts) > 1:
+			return key[:-len(parts[-1]) - 1]
+		if len(parts) == 3 and parts[1].isdigit():
+			return parts[0]
+		return None
+
+	def get(self, prefix):
+		""" Returns the data of the formset with the given prefix.
+		"""
+		return self.slices.get(prefix) or MultiValueDict()
+
 class BaseNestedFormset(BaseInlineFormSet):
 
 	def __init__(self, *args, **kwargs):
+		self.data_index = kwargs.pop("data_index", None)
+		if self.data_index is None:
+			data = kwargs.get("data", args[0] if args else None)
+			if data is not None and DataIndex.is_worth_it(data):
+				self.data_index = DataIndex(data)
+		self.child_limit = kwargs.pop("child_limit", None)
+		self.child_offset = kwargs.pop("child_offset", 0) or 0
+		self.has_more = False
 		super(BaseNestedFormset, self).__init__(*args, **kwargs)
 		for form in self.forms:
 			form.fields["DELETE"].widget = HiddenInput()
@@ -221,48 +414,152 @@ class BaseNestedFormset(BaseInlineFormSet):
 
 	def add_fields(self, form, index):
 		super(BaseNestedFormset, self).add_fields(form, index)
-
-	def is_valid(self):
-		""" Check if the other nested forms are valid as well
+		# BaseInlineFormSet appends the fk name to form._meta.fields on every
+		# call. Our formset classes are shared (see get_inline_formset_class)
+		# so make sure that list doesn't keep on growing.
+		meta_fields = form._meta.fields
+		if meta_fields and meta_fields.count(self.fk.name) > 1:
+			meta_fields.remove(self.fk.name)
+
+	def get_queryset(self):
+		""" Serves the children straight off the parent instance when they
+			were prefetched (see get_nested_queryset) instead of running
+			another query for every parent row.
+		"""
+		if not hasattr(self, "_queryset"):
+			prefetched = getattr(self.instance, "_prefetched_objects_cache", {})
+			if self.rel_name in prefetched:
+				self._queryset = PrefetchedRows(prefetched[self.rel_name],
+					ordered=bool(self.model._meta.ordering))
+			queryset = super(BaseNestedFormset, self).get_queryset()
+			if self.child_limit is not None and not self.is_bound:
+				self._queryset = self.get_window(queryset)
+		return super(BaseNestedFormset, self).get_queryset()
+
+	def get_window(self, queryset):
+		""" Returns the child_limit children starting at child_offset. Bound
+			formsets always get all the children since they look up the
+			submitted children by their primary key.
+		"""
+		offset, limit = self.child_offset, self.child_limit
+		rows = list(queryset[offset:offset + limit + 1])
+		self.has_more = len(rows) > limit
+		return ChildWindow(rows[:limit], offset, self.has_more, queryset.db)
+
+	def _construct_forms(self):
+		if self.is_bound or not self.child_offset:
+			return super(BaseNestedFormset, self)._construct_forms()
+		# Only build the forms of the children in our window
+		self.forms = []
+		for i in range(self.child_offset, self.total_form_count()):
+			self.forms.append(self._construct_form(i))
+
+	# The formset of the children of every form, see nested_formset_factory
+	nested_formset_class = None
+
+	def _construct_form(self, i, **kwargs):
+		if issubclass(self.form, NestedModelForm):
+			kwargs.setdefault("child_limit", self.child_limit)
+			kwargs.setdefault("data_index", self.data_index)
+		form = super(BaseNestedFormset, self)._construct_form(i, **kwargs)
+		form.parent_formset = self
+		if self.nested_formset_class is not None and \
+				not hasattr(form, "inline_form"):
+			prefix = "%s-%s" % (form.prefix,
+				self.nested_formset_class.get_default_prefix())
+			data = form.data if form.is_bound else None
+			if form.is_bound and self.data_index is not None:
+				data = self.data_index.get(prefix)
+			form.inline_form = self.nested_formset_class(
+				instance=form.instance,
+				data=data,
+				prefix=prefix,
+				child_limit=self.child_limit,
+				data_index=self.data_index)
+			form.inline_form.parent_form = form
+		return form
+
+	def is_valid(self, changed_only=False):
+		""" Check if the other nested forms are valid as well. Django calls
+			is_valid() again without arguments (e.g. for deleted_forms and
+			validate_unique while saving), so changed_only sticks once set.
 		"""
+		changed_only = changed_only or getattr(self, "_changed_only", False)
+		self._changed_only = changed_only
+		if changed_only:
+			self.skip_unchanged_forms()
 		result = super(BaseNestedFormset, self).is_valid()
 		for form in self.forms:
-			result = result and form.inline_form.is_valid() if hasattr(form, "inline_form") else result
+			if changed_only and not tree_has_changed(form):
+				continue
+			result = result and form.inline_form.is_valid(changed_only=changed_only) if hasattr(form, "inline_form") else result
 			#print("  Is %s valid? %s" % (form.__class__.__name__, result))
 		return result
 
-	def save(self, commit=True):
+	def skip_unchanged_forms(self):
+		""" Lets the existing rows that were not changed, and whose children
+			weren't either, skip their validation: a form that permits being
+			empty isn't cleaned as long as it hasn't changed. The model
+			formsets only save changed rows anyway.
+		"""
+		for form in self.initial_forms:
+			if not tree_has_changed(form):
+				form.empty_permitted = True
+
+	def save(self, commit=True, changed_only=False):
+		if changed_only:
+			self._changed_only = True
 		result = super(BaseNestedFormset, self).save(commit=commit)
 		# for form in self.forms:
 		# 	if hasattr(form, "inline_form"):			
 		# 		form.inline_form.save(commit=commit)
-		cleaned_datas = self.cleaned_data
-		for i in range(len(self.forms)):
-			form = self.forms[i]
-			cleaned_data = cleaned_datas[i]
+		# Not self.cleaned_data, which validates the whole formset again
+		for form in self.forms:
+			if changed_only and not tree_has_changed(form):
+				continue
+			cleaned_data = getattr(form, "cleaned_data", {})
 			save_formset = not cleaned_data.get("DELETE")
 			if hasattr(form, "inline_form"):
-				form.inline_form.save(commit=commit, save_formset=save_formset)
-				print("Saving form: %s" % form.__class__.__name__)
+				form.inline_form.save(commit=commit, save_formset=save_formset,
+					changed_only=changed_only)
 		return result
 
-def nested_formset_factory(parent_model, child_model, grandchild_model=None):
-	""" Create a formset factory that handles a 3-level relationship
+""" The formset class graphs built by nested_formset_factory, keyed on
+	(model path, form classes, extra)
+"""
+_nested_formsets = {}
+
+def nested_formset_factory(parent_model, child_model, *models, **kwargs):
+	""" Creates the inline formset class of the children of parent_model,
+		whose forms get the formset of their own children and so on down
+		the given path of models, however deep, e.g.
+		nested_formset_factory(Block, Building, Tenant, Furniture).
+		The formset class of the level below is nested_formset_class (None
+		on the last level). forms optionally gives the form class of every
+		level below parent_model and extra the number of extra forms.
+		The whole graph of classes is built once and then reused.
 	"""
-	parent_child = inlineformset_factory(
-		parent_model,
-		child_model,
-		formset=BaseNestedFormset,
-		extra=1
-		)
-
-	parent_child.nested_formset_class = inlineformset_factory(
-		child_model,
-		grandchild_model,
-		formset=BaseNestedFormset,
-		extra=1
-		)
-	return parent_child
+	models = tuple(model for model in (parent_model, child_model) + models
+		if model is not None)
+	forms = tuple(kwargs.pop("forms", None) or (ModelForm,) * (len(models) - 1))
+	extra = kwargs.pop("extra", 1)
+	if kwargs:
+		raise TypeError("Unexpected arguments: %s" % ", ".join(kwargs))
+	if len(forms) != len(models) - 1:
+		raise ValueError("Give one form class per model below %s" %
+			parent_model.__name__)
+	key = (models, forms, extra)
+	FormSet = _nested_formsets.get(key)
+	if FormSet is None:
+		# Build the classes bottom up, every one points at the one below
+		for i in reversed(range(len(forms))):
+			NestedFormSet = FormSet
+			FormSet = inlineformset_factory(models[i], models[i + 1],
+				formset=ManangeFormCachedBaseInlineFormset, form=forms[i],
+				extra=extra)
+			FormSet.nested_formset_class = NestedFormSet
+		FormSet = _nested_formsets.setdefault(key, FormSet)
+	return FormSet
 
 class ManangeFormCachedBaseInlineFormset(BaseNestedFormset):
 
@@ -272,8 +569,277 @@ class ManangeFormCachedBaseInlineFormset(BaseNestedFormset):
 			self._management_form = super(ManangeFormCachedBaseInlineFormset, self).management_form
 		return self._management_form
 
-	def save(self, commit=True, save_formset=True):
+	def save(self, commit=True, save_formset=True, changed_only=False):
 		if save_formset:
-			super(ManangeFormCachedBaseInlineFormset, self).save(commit=commit)
-			print(" Saving formset: %s" % self.__class__.__name__)
+			super(ManangeFormCachedBaseInlineFormset, self).save(commit=commit,
+				changed_only=changed_only)
+		else:
+			logger.debug("Not saving %s, the row it belongs to is being "
+				"deleted", self.__class__.__name__)
+
+
+def get_save_counts(form):
+	""" Returns the number of rows the nested formsets of the given (saved)
+		form created, updated and deleted per model, in the same shape as
+		nest.bulk.BulkSaver.counts.
+	"""
+	counts = {"created": {}, "updated": {}, "deleted": {}}
+	forms = [form]
+	while forms:
+		formset = getattr(forms.pop(), "inline_form", None)
+		if formset is None:
+			continue
+		label = get_model_label(formset.model)
+		for action, objects in (
+				("created", getattr(formset, "new_objects", None)),
+				("updated", getattr(formset, "changed_objects", None)),
+				("deleted", getattr(formset, "deleted_objects", None))):
+			if objects:
+				counts[action][label] = counts[action].get(label, 0) + \
+					len(objects)
+		forms.extend(formset.forms)
+	return counts
+
+def log_save_counts(form):
+	""" Logs one line with the totals of a saved top level form, the counts
+		per model go along as the nest_save_counts attribute of the record.
+	"""
+	if not logger.isEnabledFor(logging.INFO):
+		return
+	counts = getattr(form, "save_counts", {})
+	totals = dict((action, sum(per_model.values()))
+		for action, per_model in counts.items())
+	logger.info("Saved %s %s: %s created, %s updated, %s deleted",
+		form.__class__.__name__, form.instance.pk, totals.get("created", 0),
+		totals.get("updated", 0), totals.get("deleted", 0),
+		extra={"nest_form": form.__class__.__name__,
+			"nest_save_counts": counts})
+
+
+""" Registry of the inline formset classes used by NestedModelForm, keyed on
+	(parent model, child model, child form, formset base). Building these
+	classes is expensive so we only ever want to do it once per process.
+"""
+_formset_registry = {}
+
+def get_inline_formset_class(parent_model, child_model, child_form,
+		formset=None):
+	""" Returns the inline formset class for the given parent and child,
+		creating (and registering) it the first time it is asked for.
+	"""
+	if formset is None:
+		formset = ManangeFormCachedBaseInlineFormset
+	key = (parent_model, child_model, child_form, formset)
+	InlineFormset = _formset_registry.get(key)
+	if InlineFormset is None:
+		InlineFormset = inlineformset_factory(parent_model, child_model,
+			extra=0, formset=formset, form=child_form)
+		# Another thread may have beaten us to it, keep the first class
+		InlineFormset = _formset_registry.setdefault(key, InlineFormset)
+	return InlineFormset
+
+def get_nested_form_classes(form_class=None):
+	""" Returns all the subclasses of the given form class (NestedModelForm
+		by default).
+	"""
+	form_class = form_class or NestedModelForm
+	form_classes = []
+	for subclass in form_class.__subclasses__():
+		form_classes.append(subclass)
+		form_classes.extend(get_nested_form_classes(subclass))
+	return form_classes
+
+def warm_formset_registry(*form_classes):
+	""" Fills the formset registry (and the schemas) for the given form
+		classes (all the NestedModelForm subclasses by default) and all of
+		their descendants. This should be called once at start up (e.g.
+		from the urls.py) so that requests only ever need to instantiate the
+		formsets. No form is instantiated, see get_schema.
+	"""
+	form_classes = form_classes or get_nested_form_classes()
+	for form_class in form_classes:
+		get_schema(form_class)
+	return _formset_registry
+
+
+class NestLevel(object):
+	""" One level of the tree of a nested form class: the form class of its
+		rows and how those hang off the level above. The root level has no
+		parent, formset_class, rel_name or prefix.
+	"""
+
+	def __init__(self, form_class, parent=None, formset_class=None,
+			actions_form_class=None):
+		self.form_class = form_class
+		self.model = form_class._meta.model
+		self.parent = parent
+		self.depth = parent.depth + 1 if parent is not None else 0
+		# The inline formset class the parent's rows hold these rows in
+		self.formset_class = formset_class
+		# The form with the actions on these rows (e.g. "Add Tenant")
+		self.actions_form_class = actions_form_class
+		self.prefix = None
+		self.rel_name = None
+		if formset_class is not None:
+			# The default prefix of an inline formset is the accessor of
+			# the related rows (hidden relations can't be nested anyway)
+			self.prefix = formset_class.get_default_prefix()
+			self.rel_name = self.prefix
+		self.form_name = form_class.__name__
+		self.template_name = "%s-template" % form_class.__name__
+		self.child = None
+
+	def __repr__(self):
+		return "<NestLevel %s: %s>" % (self.depth, self.form_name)
+
+""" The schemas compiled so far, keyed on (form class, child form, child
+	actions form)
+"""
+_schemas = {}
+
+def get_schema(form_class, child_form=None, child_actions_form=None):
+	""" Returns the levels (see NestLevel) of the tree of the given nested
+		form class, root first. The tree is read off the child_form_class
+		and child_actions_form_class declared on the form classes (the
+		child form of the root can be given, like the constructor takes
+		it) and compiled once, without instantiating any form.
+	"""
+	# Resolve the defaults first so that a form class and its instances
+	# (which always know their child form) share the same schema
+	child_form = child_form or getattr(form_class, "child_form_class", None)
+	actions_form = child_actions_form or \
+		getattr(form_class, "child_actions_form_class", None)
+	key = (form_class, child_form, actions_form)
+	schema = _schemas.get(key)
+	if schema is None:
+		levels = [NestLevel(form_class)]
+		while child_form is not None:
+			parent = levels[-1]
+			if child_form in [level.form_class for level in levels]:
+				raise ValueError("%s can't be nested in itself" %
+					child_form.__name__)
+			formset_class = get_inline_formset_class(parent.model,
+				child_form._meta.model, child_form)
+			level = NestLevel(child_form, parent, formset_class, actions_form)
+			parent.child = level
+			levels.append(level)
+			actions_form = getattr(child_form, "child_actions_form_class", None)
+			child_form = getattr(child_form, "child_form_class", None)
+		schema = _schemas.setdefault(key, levels)
+	return schema
+
+def get_form_schema(form):
+	""" Returns the schema of the given form class or form, taking the
+		child form the form was constructed with into account.
+	"""
+	if inspect.isclass(form):
+		return get_schema(form)
+	return get_schema(form.__class__, getattr(form, "child_form", None),
+		getattr(form, "child_actions_form", None))
+
+def get_json_form_data(form_class, tree, prefix="", child_form=None,
+		child_actions_form=None):
+	""" Turns a JSON submission of the tree of the given nested form class
+		into the data the form (and its nested formsets) take, in one walk
+		down the schema. The tree holds the fields of the row and a list of
+		rows under the rel_name of every level, e.g.
+		{"name": "Block", "buildings": [{"id": 1, "name": "A",
+			"tenants": [...]}, {"name": "New building"}]}
+		The management forms are filled in from the lists; rows with an id
+		are the existing ones. True is sent as "on" and False left out,
+		like checkboxes do.
+	"""
+	if not isinstance(tree, dict):
+		raise ValueError("A JSON submission must be an object")
+	data = MultiValueDict()
+	schema = get_schema(form_class, child_form, child_actions_form)
+	nodes = [(schema[0], tree, prefix)]
+	while nodes:
+		level, node, prefix = nodes.pop()
+		rel_name = level.child.rel_name if level.child is not None else None
+		for name, value in node.items():
+			if name == rel_name or value is False:
+				continue
+			key = "%s-%s" % (prefix, name) if prefix else name
+			values = value if isinstance(value, list) else [value]
+			data.setlist(key, ["on" if value is True else
+				"" if value is None else value for value in values])
+		if rel_name is None:
+			continue
+		rows = node.get(rel_name) or []
+		if not isinstance(rows, list):
+			raise ValueError("%s must be a list of objects" % rel_name)
+		rows = [row for row in rows if row is not None]
+		if not all(isinstance(row, dict) for row in rows):
+			raise ValueError("%s must be a list of objects" % rel_name)
+		existing = [row for row in rows if row.get("id")]
+		rows = existing + [row for row in rows if not row.get("id")]
+		child_prefix = "%s-%s" % (prefix, rel_name) if prefix else rel_name
+		data["%s-TOTAL_FORMS" % child_prefix] = str(len(rows))
+		data["%s-INITIAL_FORMS" % child_prefix] = str(len(existing))
+		max_num = level.child.formset_class.max_num
+		data["%s-MAX_NUM_FORMS" % child_prefix] = \
+			str(max_num) if max_num is not None else ""
+		for i, row in enumerate(rows):
+			nodes.append((level.child, row, "%s-%s" % (child_prefix, i)))
+	return data
+
+def get_parent_fk(model):
+	""" Returns the foreign key from the given model to its parent in the
+		nested forms (going by the registered formsets), or None.
+	"""
+	if not _formset_registry:
+		warm_formset_registry()
+	for FormSet in list(_formset_registry.values()):
+		if FormSet.model is model:
+			return FormSet.fk
+	return None
+
+def get_lineage(obj):
+	""" Returns the (model, pk) of the given row and of all its ancestors,
+		e.g. the tenant, its building and its block. This takes a query for
+		every ancestor above the parent.
+	"""
+	model = obj.__class__
+	lineage = [(model, obj.pk)]
+	fk = get_parent_fk(model)
+	pk = getattr(obj, fk.attname) if fk is not None else None
+	while pk is not None:
+		model = fk.rel.to
+		lineage.append((model, pk))
+		fk = get_parent_fk(model)
+		if fk is None:
+			break
+		pks = list(model._default_manager.filter(pk=pk).values_list(
+			fk.attname, flat=True)[:1])
+		pk = pks[0] if pks else None
+	return lineage
+
+_prefetch_lookups = {}
+
+def get_prefetch_lookup(form_class):
+	""" Returns the prefetch_related lookup covering the whole tree of the
+		given form class e.g. "buildings__tenants__furniture" for BlockForm.
+		Returns an empty string for forms without any children.
+	"""
+	lookup = _prefetch_lookups.get(form_class)
+	if lookup is None:
+		rel_names = [level.rel_name for level in get_schema(form_class)[1:]]
+		lookup = _prefetch_lookups.setdefault(form_class, "__".join(rel_names))
+	return lookup
+
+def get_nested_queryset(form_class, queryset=None):
+	""" Returns a queryset for the model of the given form class that
+		prefetches the whole tree of children, one query per level.
+		Instances loaded from it can be handed to the form class and none of
+		the nested inline forms will hit the database again, so the number
+		of queries depends on the depth of the tree and not on the number
+		of rows in it.
+	"""
+	if queryset is None:
+		queryset = form_class._meta.model._default_manager.all()
+	lookup = get_prefetch_lookup(form_class)
+	if lookup:
+		queryset = queryset.prefetch_related(lookup)
+	return queryset
 
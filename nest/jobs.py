@@ -0,0 +1,209 @@
+""" Saving validated nested forms in the background.
+
+	submit_save captures the cleaned tree of a validated nested form as
+	plain data (see serialize_tree) and hands it to a pool of worker
+	threads, so the view can answer straight away with the id of the job.
+	The workers never touch the forms, only that data (see
+	save_tree_data). The state of the jobs is kept in the Django cache so
+	that any process sharing the cache can report on them, see get_job.
+
+	NEST_BACKGROUND_WORKERS sets the number of threads (4 by default); with
+	0 the jobs run right away in the calling thread, which is handy for
+	tests. Finished jobs are kept for NEST_JOB_TIMEOUT seconds (an hour by
+	default).
+"""
+import logging
+import threading
+import uuid
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections, router
+
+from nest.bulk import atomic, get_model_label
+from nest.cache import bump_versions
+
+logger = logging.getLogger(__name__)
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+	""" Returns the pool of worker threads (None when the jobs run in the
+		calling thread), starting it the first time it is asked for.
+	"""
+	global _pool
+	workers = getattr(settings, "NEST_BACKGROUND_WORKERS", 4)
+	if not workers:
+		return None
+	with _pool_lock:
+		if _pool is None:
+			_pool = ThreadPool(workers)
+	return _pool
+
+def get_model(label):
+	from django.db.models import get_model as get_django_model
+	app_label, object_name = label.split(".")
+	return get_django_model(app_label, object_name)
+
+def dump_value(field, obj):
+	value = getattr(obj, field.attname)
+	return None if value is None else field.value_to_string(obj)
+
+def load_value(field, value):
+	if value is None:
+		return None
+	if field.rel is not None:
+		return field.rel.get_related_field().to_python(value)
+	return field.to_python(value)
+
+def serialize_tree(form, fk=None):
+	""" Returns the cleaned data of the given validated nested form and of
+		all of its nested forms as plain, JSON serialisable, data:
+		{"model": "nest.Building", "pk": 1 (None for new rows),
+		 "fk": the foreign key to the parent row, "delete": false,
+		 "fields": {field name: value as a string}, "children": [...]}
+		Only the rows that were changed (or have changed children) are in
+		it and only the changed rows have their fields.
+	"""
+	from nest.forms import tree_has_changed
+
+	instance = form.instance
+	opts = instance._meta
+	fields = {}
+	if form.has_changed() or instance.pk is None:
+		for field in opts.fields:
+			if field.primary_key or field.name not in form.cleaned_data or \
+					(fk is not None and field.name == fk.name):
+				continue
+			fields[field.attname] = dump_value(field, instance)
+	node = {
+		"model": get_model_label(instance.__class__),
+		"pk": instance.pk,
+		"fk": fk.attname if fk is not None else None,
+		"delete": False,
+		"fields": fields,
+		"children": [],
+	}
+	formset = getattr(form, "inline_form", None)
+	if formset is None:
+		return node
+	initial_form_count = formset.initial_form_count()
+	for i, child in enumerate(formset.forms):
+		if not tree_has_changed(child):
+			continue
+		if formset.can_delete and formset._should_delete_form(child):
+			if i < initial_form_count and child.instance.pk is not None:
+				node["children"].append({
+					"model": get_model_label(child.instance.__class__),
+					"pk": child.instance.pk,
+					"delete": True,
+				})
+			continue
+		node["children"].append(serialize_tree(child, formset.fk))
+	return node
+
+def save_tree_data(tree, using=None):
+	""" Saves a tree captured by serialize_tree, parents first, in one
+		transaction. Returns the top level row and the counts of the rows
+		created, updated and deleted per model.
+	"""
+	counts = {"created": {}, "updated": {}, "deleted": {}}
+
+	def count(action, model):
+		label = get_model_label(model)
+		counts[action][label] = counts[action].get(label, 0) + 1
+
+	model = get_model(tree["model"])
+	if using is None:
+		using = router.db_for_write(model)
+	root = None
+	with atomic(using=using):
+		nodes = [(tree, None)]
+		while nodes:
+			node, parent = nodes.pop()
+			model = get_model(node["model"])
+			manager = model._default_manager.db_manager(using)
+			if node["delete"]:
+				manager.filter(pk=node["pk"]).delete()
+				count("deleted", model)
+				continue
+			obj = manager.get(pk=node["pk"]) if node["pk"] is not None \
+				else model()
+			fields = dict((field.attname, field)
+				for field in model._meta.fields)
+			for attname, value in node["fields"].items():
+				setattr(obj, attname, load_value(fields[attname], value))
+			if node["fk"] is not None:
+				setattr(obj, node["fk"], parent.pk)
+			if obj.pk is None:
+				obj.save(using=using, force_insert=True)
+				count("created", model)
+			elif node["fields"]:
+				obj.save(using=using)
+				count("updated", model)
+			if root is None:
+				root = obj
+			for child in node["children"]:
+				nodes.append((child, obj))
+	return root, counts
+
+def get_job_key(job_id):
+	return "nest-job:%s" % job_id
+
+def set_job(job_id, **job):
+	job["id"] = job_id
+	cache.set(get_job_key(job_id), job,
+		getattr(settings, "NEST_JOB_TIMEOUT", 3600))
+
+def get_job(job_id):
+	""" Returns the state of the given job: {"id": ..., "status": one of
+		pending, running, done, failed} plus the "pk" of the saved row and
+		the "counts" when it is done, or the "error" when it failed. None
+		for unknown (or long gone) jobs.
+	"""
+	return cache.get(get_job_key(job_id))
+
+def run_job(job_id, tree):
+	set_job(job_id, status=RUNNING)
+	try:
+		root, counts = save_tree_data(tree)
+		if getattr(settings, "NEST_FRAGMENT_CACHE", False):
+			from nest.forms import get_lineage
+			bump_versions(get_lineage(root))
+	except Exception as e:
+		logger.exception("Saving %s in the background failed", tree["model"])
+		set_job(job_id, status=FAILED, error=str(e))
+	else:
+		logger.info("Saved %s %s in the background", tree["model"], root.pk,
+			extra={"nest_job": job_id, "nest_save_counts": counts})
+		set_job(job_id, status=DONE, pk=root.pk, counts=counts)
+
+def run_pooled_job(job_id, tree):
+	try:
+		run_job(job_id, tree)
+	finally:
+		# Worker threads get connections of their own, don't leak them
+		for connection in connections.all():
+			connection.close()
+
+def submit_save(form):
+	""" Queues the save of the given validated nested form and returns the
+		id of the job, see get_job.
+	"""
+	tree = serialize_tree(form)
+	job_id = uuid.uuid4().hex
+	set_job(job_id, status=PENDING)
+	pool = get_pool()
+	if pool is None:
+		run_job(job_id, tree)
+	else:
+		pool.apply_async(run_pooled_job, (job_id, tree))
+	return job_id
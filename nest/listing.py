@@ -0,0 +1,160 @@
+""" Listing whole trees of nested rows, e.g. every block with its
+	buildings, their tenants and their furniture, in a fixed number of
+	queries: one per level (and one to count the rows when paginating)
+	however many rows there are.
+
+	The levels are normally prefetched one after the other, each query
+	waiting for the rows of the level above. With NEST_LOADER_THREADS set
+	(see load_trees) every level is queried straight off the top level
+	rows instead, so the queries don't depend on each other and run at the
+	same time on that many threads.
+"""
+import threading
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
+from django.db import DatabaseError, connections, router, transaction
+
+from nest.forms import get_nested_queryset, get_prefetch_lookup, get_schema
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def annotate_counts(rows, rel_names):
+	""" Sets a <rel_name>_count attribute with the number of children on
+		every (prefetched) row of the tree, e.g. block.buildings_count.
+	"""
+	level = rows
+	for rel_name in rel_names:
+		next_level = []
+		for row in level:
+			children = list(getattr(row, rel_name).all())
+			setattr(row, "%s_count" % rel_name, len(children))
+			next_level.extend(children)
+		level = next_level
+
+def get_pool(threads):
+	with _pools_lock:
+		if threads not in _pools:
+			_pools[threads] = ThreadPool(threads)
+	return _pools[threads]
+
+def can_share_database(using):
+	""" Returns whether other threads see the same database, which they
+		don't for in-memory SQLite databases (e.g. when testing).
+	"""
+	connection = connections[using]
+	return not (connection.vendor == "sqlite" and
+		connection.settings_dict["NAME"] in ("", ":memory:"))
+
+def fetch(queryset):
+	""" Runs the query on a thread of the pool. Connections are per thread
+		and the pool's threads live as long as the process, so every one
+		of them keeps its connection open for the next page instead of
+		paying for a new one on every query. The price is up to
+		NEST_LOADER_THREADS idle connections per database held for good
+		(mind the connection limit of the server). A connection that went
+		bad is closed so that the next query on the thread reconnects.
+		Nothing ends the transactions of the pool's threads for them (the
+		requests do that for their own thread), so the read transaction is
+		rolled back after every query: it would otherwise stay open (idle
+		in transaction) and, on REPEATABLE READ databases, keep reading the
+		rows as they were at its first query.
+	"""
+	try:
+		return list(queryset)
+	except DatabaseError:
+		connections[queryset.db].close()
+		raise
+	finally:
+		# Django 1.6 and up run in autocommit, there is nothing to end
+		if hasattr(transaction, "rollback_unless_managed"):
+			transaction.rollback_unless_managed(using=queryset.db)
+
+def load_trees(form_class, rows, threads=None, using=None):
+	""" Loads the whole trees of children (see get_schema) of the given rows
+		of the model of the given nested form class, with one query per
+		level. Every level is looked up through the foreign keys up to the
+		given rows, e.g. the furniture with tenant__building__block__in, so
+		the queries run on threads (NEST_LOADER_THREADS of them by default)
+		at the same time. The children are then handed to their parents the
+		way prefetch_related does, so the nested forms won't query them
+		again. Without threads, or with a database that other threads don't
+		see, the queries run one after the other in here.
+	"""
+	schema = get_schema(form_class)
+	if not rows or len(schema) < 2:
+		return rows
+	if threads is None:
+		threads = getattr(settings, "NEST_LOADER_THREADS", 0)
+	if using is None:
+		using = rows[0]._state.db or router.db_for_read(schema[0].model)
+	pks = [row.pk for row in rows]
+	querysets = []
+	path = []
+	for level in schema[1:]:
+		path.insert(0, level.formset_class.fk.name)
+		querysets.append(level.model._default_manager.db_manager(using).filter(
+			**{"%s__in" % "__".join(path): pks}))
+	if threads and threads > 1 and can_share_database(using):
+		levels = get_pool(threads).map(fetch, querysets)
+	else:
+		levels = [list(queryset) for queryset in querysets]
+
+	parents = rows
+	for level, children in zip(schema[1:], levels):
+		fk = level.formset_class.fk
+		by_parent = dict((parent.pk, []) for parent in parents)
+		parents_by_pk = dict((parent.pk, parent) for parent in parents)
+		for child in children:
+			parent_pk = getattr(child, fk.attname)
+			by_parent[parent_pk].append(child)
+			setattr(child, fk.get_cache_name(), parents_by_pk[parent_pk])
+		for parent in parents:
+			queryset = getattr(parent, level.rel_name).all()
+			queryset._result_cache = by_parent[parent.pk]
+			queryset._prefetch_done = True
+			if not hasattr(parent, "_prefetched_objects_cache"):
+				parent._prefetched_objects_cache = {}
+			parent._prefetched_objects_cache[level.rel_name] = queryset
+		parents = children
+	return rows
+
+def get_hierarchy(form_class, queryset=None):
+	""" Returns the rows of the model of the given nested form class with
+		their whole tree of children loaded, see get_nested_queryset (or
+		load_trees with NEST_LOADER_THREADS), and counted, see
+		annotate_counts.
+	"""
+	if getattr(settings, "NEST_LOADER_THREADS", 0):
+		if queryset is None:
+			queryset = form_class._meta.model._default_manager.all()
+		rows = load_trees(form_class, list(queryset))
+	else:
+		rows = list(get_nested_queryset(form_class, queryset))
+	lookup = get_prefetch_lookup(form_class)
+	if lookup:
+		annotate_counts(rows, lookup.split("__"))
+	return rows
+
+def get_hierarchy_page(form_class, page=1, per_page=None, queryset=None):
+	""" Returns a page (see django.core.paginator) of the rows of the model
+		of the given form class, holding per_page rows (NEST_LISTING_PAGE_SIZE
+		by default) with their trees loaded as get_hierarchy does. Bad page
+		numbers get the first page and the ones past the end the last one.
+	"""
+	if queryset is None:
+		queryset = form_class._meta.model._default_manager.order_by("pk")
+	if per_page is None:
+		per_page = getattr(settings, "NEST_LISTING_PAGE_SIZE", 100)
+	paginator = Paginator(queryset, per_page)
+	try:
+		page = paginator.page(page)
+	except PageNotAnInteger:
+		page = paginator.page(1)
+	except EmptyPage:
+		page = paginator.page(paginator.num_pages)
+	page.object_list = get_hierarchy(form_class, page.object_list)
+	return page
@@ -0,0 +1,96 @@
+import json
+import platform
+import subprocess
+from optparse import make_option
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.conf import settings
+
+from nest.benchmarks import (BENCHMARKS, run_benchmarks, run_client_benchmark,
+    run_rewrite_benchmark)
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"],
+            cwd=settings.PROJECT_ROOT).decode("utf-8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_safely(name, benchmark, **kwargs):
+    """ Runs the benchmark, a failure is reported in its result instead of
+        losing the results of all the others.
+    """
+    try:
+        return benchmark(**kwargs)
+    except Exception as e:
+        return {"name": name, "error": "%s: %s" % (e.__class__.__name__, e)}
+
+
+class Command(BaseCommand):
+    help = ("Times constructing, rendering, validating and saving nested "
+        "forms on a test database and writes the results as JSON")
+
+    option_list = BaseCommand.option_list + (
+        make_option("--widths", default="10,5,2",
+            help="Children per row on every level, e.g. 10,5,2 for 10 "
+                "buildings with 5 tenants with 2 pieces of furniture"),
+        make_option("--repeat", type="int", default=3,
+            help="How many times to run every benchmark"),
+        make_option("--benchmark", action="append", dest="names",
+            help="Only run this benchmark (can be given more than once)"),
+        make_option("--clients", type="int", default=4,
+            help="Number of concurrent clients getting the edit page in the "
+                "edit_page_clients benchmark"),
+        make_option("--output", default=None,
+            help="File to write the JSON results to (default: stdout)"),
+    )
+
+    def handle(self, *args, **options):
+        try:
+            widths = [int(width) for width in options["widths"].split(",")]
+        except ValueError:
+            raise CommandError("--widths takes numbers, e.g. 10,5,2")
+        names = options.get("names")
+        known = [name for name, setup, run in BENCHMARKS]
+        known.extend(["edit_page_clients", "rewrite_templates"])
+        for name in names or []:
+            if name not in known:
+                raise CommandError("Unknown benchmark %s, pick one of %s" % (
+                    name, ", ".join(known)))
+
+        results = []
+        # This one doesn't need a database, run it first so that it can't
+        # hold up the others
+        if not names or "rewrite_templates" in names:
+            results.append(run_safely("rewrite_templates",
+                run_rewrite_benchmark, repeat=options["repeat"]))
+
+        # Never touch the real database
+        old_name = settings.DATABASES["default"]["NAME"]
+        connection.creation.create_test_db(verbosity=0)
+        try:
+            results.extend(run_benchmarks(widths=widths,
+                repeat=options["repeat"], names=names))
+            if not names or "edit_page_clients" in names:
+                results.append(run_safely("edit_page_clients",
+                    run_client_benchmark, widths=widths,
+                    clients=options["clients"]))
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+
+        report = json.dumps({
+            "commit": get_commit(),
+            "python": platform.python_version(),
+            "django": django.get_version(),
+            "database": connection.vendor,
+            "results": results,
+        }, indent=2, sort_keys=True)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(report)
+        else:
+            self.stdout.write(report)
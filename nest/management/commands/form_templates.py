@@ -1,3 +1,7 @@
+import hashlib
+import inspect
+import json
+import multiprocessing
 import os
 from optparse import make_option
 import importlib
@@ -9,21 +13,134 @@ from django.forms import ModelForm
 from django.template import Context
 from django.template.loader import get_template
 from django.conf import settings
+from django.utils.encoding import force_text
 
 from nest import forms
-from nest.forms import NestedModelForm
+from nest.bundle import write_bundle
+from nest.forms import NestedModelForm, get_inline_formset_class
+from nest.templatetags.nested_crispy import get_form_name, get_default_helper
 
 OUTPUT_DIR = "%s/form_templates" % settings.PROJECT_ROOT
-if not os.path.exists(OUTPUT_DIR):
-    os.mkdir(OUTPUT_DIR)
+MANIFEST_NAME = "manifest.json"
+
+""" Everything rewrite_template changes in one pattern:
+    - ="div_id_name" -> ="div_id_{prefix}-{index}-name"
+    - ="id_name" -> ="id_{prefix}-{index}-name"
+    - name="name" -> name="{prefix}-{index}-name", unless the name is an id
+      (name="id_x") which gets the id rewrite, like it always did
+"""
+REWRITE_RE = re.compile(r'="div_id_(\w+)"|="id_(\w+)"|'
+    r'name="(?!(?:div_)?id_\w+")([\w_]+)"')
+WHITESPACE = dict((ord(char), None) for char in "\n\t")
+
+
+def find_child_forms(modules):
+    """ Returns the (child form module, child form name, parent form
+        module, parent form name) of every child form declared (see
+        NestedModelForm.child_form_class) by the nested forms of the given
+        modules, without instantiating them.
+    """
+    found = []
+    for mod in modules:
+        for name, form_class in inspect.getmembers(mod, inspect.isclass):
+            if not issubclass(form_class, NestedModelForm) or \
+                    form_class.__module__ != mod.__name__:
+                continue
+            child_form = form_class.child_form_class
+            if child_form is None:
+                continue
+            item = (child_form.__module__, child_form.__name__,
+                form_class.__module__, form_class.__name__)
+            if item not in found:
+                found.append(item)
+    return found
+
+def rewrite_template(html, prefix):
+    """ Makes the rendered html of a form into a Dust template: strips the
+        new lines and tabs and puts the prefix and {index} in all the ids
+        and names, scanning the html only once.
+    """
+    def replace(match):
+        div_id, id_, name = match.groups()
+        if div_id is not None:
+            return '="div_id_%s-{index}-%s"' % (prefix, div_id)
+        if id_ is not None:
+            return '="id_%s-{index}-%s"' % (prefix, id_)
+        return 'name="%s-{index}-%s"' % (prefix, name)
+    html = force_text(html).strip().translate(WHITESPACE)
+    return REWRITE_RE.sub(replace, html).strip()
+
+def render_raw_template(item):
+    """ Renders the html of one child form, the item comes from
+        find_child_forms. Returns the name of the form, the prefix of its
+        formset and the html.
+    """
+    child_module, child_name, parent_module, parent_name = item
+    child_form = getattr(importlib.import_module(child_module), child_name)
+    parent_form = getattr(importlib.import_module(parent_module), parent_name)
+    prefix = get_inline_formset_class(parent_form._meta.model,
+        child_form._meta.model, child_form).get_default_prefix()
+    actual_form = child_form()
+    form_name = get_form_name(actual_form)
+    if getattr(actual_form, "helper", None) is None:
+        actual_form.helper = get_default_helper()
+    # disable CSRF on the helper to get rid of the warning
+    actual_form.helper.disable_csrf = True
+    # TODO: Check to ensure that the form excludes all f-keys
+    template = get_template("form_basic.html")
+    html = template.render(Context({"form" : actual_form}))
+    return form_name, prefix, html
+
+def render_form_template(item):
+    """ Renders the Dust template of one child form, the item comes from
+        find_child_forms (it only holds names so it can be sent to other
+        processes). Returns the name of the form and the template.
+    """
+    form_name, prefix, html = render_raw_template(item)
+    return form_name, rewrite_template(html, prefix)
+
+def get_hash(content):
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()
+
+def get_file_hash(filename):
+    if not os.path.exists(filename):
+        return None
+    with open(filename, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def write_if_changed(filename, content):
+    """ Writes the content to the file unless the file already holds the
+        exact same content, so that file watchers aren't woken up for
+        nothing. Returns whether the file was written.
+    """
+    if get_file_hash(filename) == get_hash(content):
+        return False
+    with open(filename, "wb") as f:
+        f.write(content.encode("utf-8"))
+    return True
+
 
 class Command(BaseCommand):
     help = "This prints out the forms"
 
+    option_list = BaseCommand.option_list + (
+        make_option("--jobs", type="int", default=None,
+            help="Number of processes rendering the templates "
+                "(the number of CPUs by default, 1 renders them in here)"),
+        make_option("--output-dir", dest="output_dir", default=OUTPUT_DIR,
+            help="Directory to write the Dust templates to"),
+        make_option("--static-dir", dest="static_dir",
+            default="%s/static" % settings.PROJECT_ROOT,
+            help="Static files directory to write the bundle of the "
+                "knockout templates to (under js/)"),
+    )
+
     def handle(self, *args, **options):
+        output_dir = options.get("output_dir") or OUTPUT_DIR
+        if not os.path.exists(output_dir):
+            os.mkdir(output_dir)
         # Loop through all installed apps and try to import forms
         modules = []
-        forms = []
         for app in settings.INSTALLED_APPS:
             try:
                 __import__("%s.forms" % app)
@@ -32,45 +149,35 @@ class Command(BaseCommand):
             except ImportError:
                 pass
 
-        for mod in modules:
-            form_list = []
-            for form_name in dir(mod):
-                try:
-                    """ We are only interested in forms that are a child of 
-                        some other form_name.
-                    """ 
-                    form = getattr(mod, form_name)
-                    actual_form = form()
-                    if isinstance(actual_form, NestedModelForm) and \
-                            actual_form.child_form is not None:
-                        # Add the class
-                        if actual_form.child_form not in form_list:
-                            form_list.append((actual_form.child_form, form))
-
-                except Exception as e:
-                    pass
-
-            template = get_template("form_basic.html")
-            for (child_form, parent_form) in form_list:
-                actual_parent_form = parent_form()
-                prefix = actual_parent_form.inline_prefix
-                actual_form = child_form()
-                form_name = actual_form.get_form_name()
-                # disable CSRF on the helper to get rid of the warning
-                actual_form.helper.disable_csrf = True
-                # TODO: Check to ensure that the form excludes all f-keys
-                print("Generating template for: %s" % actual_form.get_form_name())
-                html = template.render(Context({"form" : actual_form}))
-                html = html.strip().replace("\n","").replace("\t","")
-                # Convert id_name to id_prefix-{index}-name
-                # Do it in two stages, because we app can't have optional groups
-                html = re.sub(r'="div_id_(\w+)"',  r'="div_id_%s-{index}-\1"' % prefix, html)
-                html = re.sub(r'="id_(\w+)"',  r'="id_%s-{index}-\1"' % prefix, html)
-                # Add the prefix and index to all name="blah" 
-                html = re.sub(r'name="([\w_]+)"', r'name="%s-{index}-\1"' % prefix, html)
-
-                # Remove unnecessary spacings...
-                html = re.sub(r'(\t)+', '', html.strip())
-                filename = "%s/%s.form" % (OUTPUT_DIR, form_name)
-                with open(filename, "w") as f:
-                    f.write(html)
+        items = find_child_forms(modules)
+        jobs = options.get("jobs") or multiprocessing.cpu_count()
+        jobs = min(jobs, len(items))
+        if jobs > 1:
+            pool = multiprocessing.Pool(jobs)
+            try:
+                templates = pool.map(render_form_template, items)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            templates = [render_form_template(item) for item in items]
+
+        manifest = {}
+        for form_name, html in templates:
+            filename = "%s.form" % form_name
+            manifest[filename] = get_hash(html)
+            if write_if_changed(os.path.join(output_dir, filename), html):
+                self.stdout.write("Generated template for: %s" % form_name)
+            else:
+                self.stdout.write("Template for %s is up to date" % form_name)
+
+        # Lets other tools find out which templates changed since their last
+        # run without reading all of them
+        write_if_changed(os.path.join(output_dir, MANIFEST_NAME),
+            json.dumps(manifest, indent=2, sort_keys=True))
+
+        filename, written = write_bundle(options["static_dir"])
+        if written:
+            self.stdout.write("Bundled the knockout templates in: %s" % filename)
+        else:
+            self.stdout.write("Bundle %s is up to date" % filename)
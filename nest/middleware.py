@@ -0,0 +1,42 @@
+import json
+import logging
+
+from django.conf import settings
+
+from nest.tracing import Tracer
+
+logger = logging.getLogger("nest.tracing")
+
+
+class TracingMiddleware(object):
+	""" Traces the nested forms of every request when NEST_TRACING is set.
+		The totals per operation go into the X-Nest-Trace header and the
+		full report (see Tracer.report) is logged to the nest.tracing
+		logger.
+		Streamed responses are rendered after the response has left the
+		middleware so only their construction shows up.
+	"""
+
+	header = "X-Nest-Trace"
+
+	def process_request(self, request):
+		if getattr(settings, "NEST_TRACING", False):
+			request.nest_tracer = Tracer(name="%s %s" % (request.method,
+				request.path))
+			request.nest_tracer.__enter__()
+
+	def process_response(self, request, response):
+		tracer = getattr(request, "nest_tracer", None)
+		if tracer is None:
+			return response
+		del request.nest_tracer
+		tracer.__exit__(None, None, None)
+		summary = tracer.summary()
+		for totals in summary.values():
+			totals["time"] = round(totals["time"] * 1000, 2) # ms
+		response[self.header] = json.dumps(summary, sort_keys=True,
+			separators=(",", ":"))
+		if logger.isEnabledFor(logging.INFO):
+			logger.info("%s took %.1fms in nested forms: %s", tracer.name,
+				tracer.time * 1000, json.dumps(tracer.report()))
+		return response
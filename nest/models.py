@@ -37,3 +37,13 @@ class Furniture(models.Model):
 
 	def __unicode__(self):
 		return "Furniture: %s" % self.name
+
+class Lease(models.Model):
+	""" Not part of the nested forms, deleting a tenant takes its leases
+		with it.
+	"""
+	tenant = models.ForeignKey("Tenant", related_name="leases")
+	signed = models.DateField(blank=True, null=True)
+
+	def __unicode__(self):
+		return "Lease: %s" % self.tenant_id
@@ -0,0 +1,67 @@
+""" Streaming responses for pages holding (very) big nested forms.
+
+	The page template is rendered first with a marker in place of every
+	top level nested_form tag (and nested_form_templates tag). The response
+	then sends the page up to each marker and streams the nested form in
+	as it is being rendered, see iter_nested_form. Everything after the
+	forms (e.g. the nested_form_js bindings) follows at the end.
+"""
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from django.middleware.csrf import get_token
+from django.template import RequestContext
+from django.template.loader import get_template
+from django.utils.encoding import force_text
+
+from nest.templatetags.nested_crispy import (STREAM_MARKER, get_render_state,
+	iter_nested_form, render_deferred_templates)
+
+
+def iter_chunks(fragments, chunk_size):
+	""" Joins the given fragments into chunks of at least chunk_size
+		characters, so that we don't flush every single tag.
+	"""
+	buffer = []
+	size = 0
+	for fragment in fragments:
+		buffer.append(fragment)
+		size += len(fragment)
+		if size >= chunk_size:
+			yield "".join(buffer)
+			buffer = []
+			size = 0
+	if buffer:
+		yield "".join(buffer)
+
+def iter_streamed_page(html, context, chunk_size):
+	""" Yields the rendered page html, rendering the nested forms recorded
+		while the page was rendered in place of their markers.
+	"""
+	items = get_render_state(context, "stream_items", [])
+	for index, item in enumerate(items):
+		head, html = html.split(STREAM_MARKER % index, 1)
+		yield head
+		if item[0] == "form":
+			kind, form, helper, defer_templates = item
+			fragments = iter_nested_form(form, helper, context,
+				defer_templates=defer_templates)
+		else:
+			fragments = [render_deferred_templates(context)]
+		for chunk in iter_chunks(fragments, chunk_size):
+			yield chunk
+	yield html
+
+def render_to_streaming_response(request, template_name, dictionary=None,
+		context_instance=None):
+	""" Works like render_to_response, except that the nested forms on the
+		page are streamed out as they are rendered.
+	"""
+	context = context_instance or RequestContext(request)
+	# The CSRF token is only rendered once the headers are gone, make sure
+	# the cookie for it is sent anyway
+	get_token(request)
+	context.dicts[0]["nest_streaming"] = True
+	context.update(dictionary or {})
+	html = force_text(get_template(template_name).render(context))
+	chunk_size = getattr(settings, "NEST_STREAM_CHUNK_SIZE", 8192)
+	return StreamingHttpResponse(iter_streamed_page(html, context, chunk_size))
@@ -1,14 +1,25 @@
+import hashlib
 import json
 
+from django.conf import settings
+from django.core.cache import cache
+from django.core.urlresolvers import reverse, NoReverseMatch
 from django.template import Node, NodeList
 from django import template
+from django.utils.html import escape
+from django.utils.http import urlencode
 from django.utils.safestring import mark_safe
 from django.forms.formsets import BaseFormSet
 
 from crispy_forms.helper import FormHelper
 from crispy_forms.templatetags.crispy_forms_tags import CrispyFormNode
 
-from nest.forms import NestedModelForm, SubmitButtonField
+from nest.cache import (LRUCache, get_fingerprint, csrf_token_placeholder,
+    restore_csrf_token, get_versions)
+from nest import tracing
+from nest.bundle import get_bundle, get_class_path
+from nest.forms import (NestedModelForm, SubmitButtonField, get_lineage,
+    get_form_schema)
 
 register = template.Library()
 
@@ -30,7 +41,7 @@ register = template.Library()
 
 def get_form_template_name(form):
     if isinstance(form, type):
-        form = form()
+        return "%s-template" % form.__name__
     return "%s-template" % form.__class__.__name__
 
 def get_management_form_div_name(form, prefix=""):
@@ -50,7 +61,8 @@ def get_form_name(form, prefix=""):
     is_formset = issubclass(form.__class__, BaseFormSet)
     if not is_formset:
         if isinstance(form, type): # if it's a class, just return the name
-            return form.__name__
+            return "%s-form-%s" % (form.__name__, prefix) if prefix \
+                else form.__name__
         if form.prefix:
             prefix = form.prefix
         form_name = "%s-form-%s" % (form.__class__.__name__, prefix) if prefix \
@@ -76,151 +88,414 @@ class HtmlContent(Node):
     def render(self, context):
         return mark_safe(self.html)
 
+""" The rendered <script> templates only depend on the form classes (not on
+    the data) so they are rendered once and then served from this cache.
+    Set NEST_TEMPLATE_CACHE_SIZE to 0 to turn it off.
+"""
+template_cache = LRUCache(getattr(settings, "NEST_TEMPLATE_CACHE_SIZE", 128))
+_template_fingerprints = {}
+
+def get_template_pack():
+    return getattr(settings, "CRISPY_TEMPLATE_PACK", "bootstrap")
+
+def get_form_templates_fingerprint(form):
+    """ Returns a fingerprint of the definitions of all the form classes
+        that make up the <script> templates of the given form.
+    """
+    key = (form.__class__, getattr(form, "child_form", None),
+        getattr(form, "child_actions_form", None))
+    fingerprint = _template_fingerprints.get(key)
+    if fingerprint is None:
+        classes = [form.__class__]
+        for level in get_form_schema(form)[1:]:
+            classes.append(level.form_class)
+            classes.append(level.actions_form_class)
+        fingerprint = _template_fingerprints.setdefault(key,
+            get_fingerprint(*classes))
+    return fingerprint
+
+def get_render_state(context, name, default):
+    """ Returns a value that is shared by all the nested form tags rendered
+        for one response. It is kept at the bottom of the context so that it
+        survives context pushes and included templates.
+    """
+    return context.dicts[0].setdefault("nest_%s" % name, default)
+
+def get_emitted_templates(context):
+    """ Returns the set of template ids already sent in this response.
+    """
+    return get_render_state(context, "emitted_templates", set())
+
+def get_deferred_forms(context):
+    """ Returns the forms whose templates will be printed by the
+        nested_form_templates tag.
+    """
+    return get_render_state(context, "deferred_forms", [])
+
+def render_deferred_templates(context):
+    """ Returns the <script> templates of all the forms deferred so far.
+    """
+    deferred_forms = get_deferred_forms(context)
+    bits = [render_form_templates(form, context) for form in deferred_forms]
+    del deferred_forms[:]
+    return mark_safe("".join(bits))
+
+""" Marks the spot of a part of the page that is streamed in later on.
+"""
+STREAM_MARKER = "<!-- nest-stream-%s -->"
+
+def is_streaming(context):
+    return context.dicts[0].get("nest_streaming", False)
+
+def add_stream_item(context, *item):
+    """ Records a part of the page that will be rendered while the response
+        is streamed out (see nest.streaming) and returns the marker to put
+        in its place.
+    """
+    items = get_render_state(context, "stream_items", [])
+    items.append(item)
+    return mark_safe(STREAM_MARKER % (len(items) - 1))
+
+def render_bundled_templates(form, context):
+    """ Returns the <script> tag loading the template bundle (see
+        nest.bundle) when it holds the templates of the given form, or
+        None when it doesn't. The bundle is only loaded once per response.
+    """
+    bundle = get_bundle()
+    if bundle is None or not isinstance(form, NestedModelForm) or \
+            form.prefix or bundle.get("template_pack") != get_template_pack():
+        return None
+    fingerprint = bundle["forms"].get(get_class_path(form.__class__))
+    if fingerprint != get_form_templates_fingerprint(form):
+        return None
+    emitted = get_emitted_templates(context)
+    if bundle["file"] in emitted:
+        return mark_safe("")
+    emitted.add(bundle["file"])
+    emitted.update(bundle["templates"])
+    return mark_safe('<script src="%s%s"></script>' % (settings.STATIC_URL,
+        bundle["file"]))
+
+def render_form_templates(form, context):
+    """ Returns the <script> templates for all the children of the given
+        form, from the template cache when possible. Templates that were
+        already sent in this response are left out.
+    """
+    bundled = render_bundled_templates(form, context)
+    if bundled is not None:
+        return bundled
+    key = (get_form_templates_fingerprint(form), form.prefix,
+        get_template_pack(), bool(context.get("csrf_token")))
+    templates = template_cache.get(key)
+    if templates is None:
+        with csrf_token_placeholder(context):
+            templates = build_form_templates(form, context)
+        template_cache.set(key, templates)
+
+    emitted = get_emitted_templates(context)
+    bits = []
+    for template_name, html in templates:
+        if template_name not in emitted:
+            emitted.add(template_name)
+            bits.append(html)
+    return mark_safe(restore_csrf_token("".join(bits),
+        context.get("csrf_token")))
+
+def render_templates_once(form, context, defer=False):
+    """ Returns the <script> templates of a top level form, or leaves them
+        for the nested_form_templates tag when defer is True.
+    """
+    if not isinstance(form, NestedModelForm):
+        # Only nested forms declare the forms added in the page
+        return ""
+    if defer:
+        get_deferred_forms(context).append(form)
+        return ""
+    with tracing.span("render_templates", form):
+        return render_form_templates(form, context)
+
+def get_fragment_cache_key(form, helper, context):
+    """ Returns the key the markup of the given top level form is kept
+        under in the fragment cache, or None when it can't be cached.
+        Only unbound forms over a saved row without a helper of the tag's
+        own are cached, when NEST_FRAGMENT_CACHE is set.
+        The key holds the versions of the row and its ancestors, which the
+        nested save and delete paths bump (see nest.cache.bump_versions),
+        so anything that changes the row's tree gets it a new key.
+    """
+    if not getattr(settings, "NEST_FRAGMENT_CACHE", False):
+        return None
+    if helper is not None or not isinstance(form, NestedModelForm) or \
+            form.is_bound or form.instance.pk is None:
+        return None
+    lineage = get_lineage(form.instance)
+    bits = [get_form_templates_fingerprint(form), form.prefix,
+        get_template_pack(), form.child_limit,
+        bool(context.get("csrf_token"))]
+    bits.extend(lineage)
+    bits.extend(get_versions(lineage))
+    key = hashlib.sha1(repr(bits).encode("utf-8")).hexdigest()
+    return "nest-fragment:%s" % key
+
+def get_cached_fragment(key, context):
+    html = cache.get(key)
+    if html is None:
+        return None
+    return restore_csrf_token(html, context.get("csrf_token"))
+
+def set_cached_fragment(key, html):
+    """ Caches the markup of a form, rendered with csrf_token_placeholder.
+    """
+    timeout = getattr(settings, "NEST_FRAGMENT_CACHE_TIMEOUT", 300)
+    cache.set(key, html, timeout)
+
+def build_form_templates(form, context):
+    """ Renders the <script> templates for all the children of the given form.
+        Returns a list of (template id, html).
+    """
+    templates = []
+    child_forms = []
+    # find all inline_form that need to get printed, the parent is the form
+    # itself for its children and a class further down
+    parent_form = form
+    for level in get_form_schema(form)[1:]:
+        child_forms.append((level.form_class, parent_form))
+        parent_form = level.form_class
+
+    """ 
+        All the nested forms we print out will have this general structure
+        - <div id='{form_name}_form_div' class='form-container'> - HtmlContent
+            - Fields from the parent form 
+            -  The inline form which prints the children and management form (hidden) 
+            - <div id='{form_name}_children_div' class='form-children'>
+                --- Kids printed here ---
+              </div>
+            - <div id='{form_name}_management_form_div' class='management-form-div'>
+                - Management form (hidden)
+                - Inline actions form (if one exists)
+            - </div>
+        - </div>
+    """
+
+    # Loop through each and get the knockout templates for each
+    for child_form, parent_form in child_forms:
+        nodelist = NodeList()
+        child_form = child_form() if isinstance(child_form, type) else child_form
+        child_form.fields["delete_button"] = SubmitButtonField()
+        # Add knockoutjs bindings to the child form fields
+        for field_name, field in child_form.fields.iteritems():
+            attr = "{'id' : 'id_' + prefix + '-' + index + '-%s', 'name' : prefix + '-' + index + '-%s'}" % (field_name, field_name)
+            field.widget.attrs["data-bind"] = mark_safe("attr: %s" % attr)
+        form_name = get_form_name(child_form)
+        template_name = get_form_template_name(child_form)
+        context["child_%s" % form_name] = child_form
+        context["child_%s_helper" % form_name] = get_default_helper()
+
+        # print out the script for the template
+        nodelist.append(HtmlContent('<script type="text/html" id="%s">' % template_name))
+        form_container_attrs = "{'id': '%s_form_div' }" % get_form_name(child_form, prefix="' + prefix + '-' + index + '")
+        nodelist.append(HtmlContent('<div data-bind="attr: %s" class="form-container">' % mark_safe(form_container_attrs)))
+        nodelist.append(CrispyFormNode(form="child_%s" % form_name, 
+            helper="child_%s_helper" % form_name))
+        if hasattr(child_form, "inline_form"): # then print the management form as well
+            """ If our child has a child (e.g. building has tenants)
+                then print the management form for it's child (tenant)
+            """
+            # first we need to actually print the div to hold the kids
+            form_children_attrs = "{'id': '%s_children_div' }" % \
+                get_form_name(child_form, prefix="' + prefix + '-' + index +'")        
+            nodelist.append(HtmlContent("""
+                <div data-bind="attr: %s" class="form-children"></div>
+            """ % mark_safe(form_children_attrs)))
+
+            management_form_div_class = get_management_form_div_name(parent_form, prefix="' + prefix + '-' + index + '")
+            management_form_div_attrs = "{'id' : '%s'}" % management_form_div_class
+            nodelist.append(HtmlContent("""
+                <div data-bind="attr: %s" class='management-form-div'>
+                """ % management_form_div_attrs))
+
+            formset = child_form.inline_form
+            grand_child_management_form = child_form.inline_form.management_form
+
+            # Tweak it and adds Knockout bindings 
+            child_prefix = child_form.inline_form.prefix
+            fields = grand_child_management_form.fields
+            for field_name, field in fields.iteritems():
+                attr = "{'id' : 'id_' + prefix + '-' + index + '-%s-%s', 'name' : prefix + '-' + index + '-%s-%s'}" % (child_prefix, field_name, child_prefix, field_name)
+                if field_name == "TOTAL_FORMS":
+                    attr = "{'id' : 'id_' + prefix + '-' + index + '-%s-%s', 'name' : prefix + '-' + index + '-%s-%s', 'value': totalForms }" % (child_prefix, field_name, child_prefix, field_name)
+                field.widget.attrs["data-bind"] = mark_safe("attr: %s" % attr)
+            context["child_%s_management_form" % form_name] = grand_child_management_form
+            context["child_%s_management_form_helper" % form_name] = get_default_helper()
+            nodelist.append(CrispyFormNode("child_%s_management_form" % form_name, 
+                "child_%s_management_form_helper" % form_name))
+
+            if hasattr(formset, "actions_form") and \
+                    formset.actions_form is not None:
+                inline_actions_form_name = "%s-inline_actions_form" % get_form_name(child_form)
+                inline_actions_form_helper_name = "%s-helper" % inline_actions_form_name
+                context[inline_actions_form_name] = formset.actions_form
+                context[inline_actions_form_helper_name] = formset.actions_form().helper
+                nodelist.append(CrispyFormNode(form=inline_actions_form_name, 
+                    helper=inline_actions_form_helper_name))
+            
+            nodelist.append(HtmlContent("</div>")) # end of the management form div
+        nodelist.append(HtmlContent("</div>")) # end of form-cotnainer
+
+        nodelist.append(HtmlContent("</script>"))
+        templates.append((template_name, nodelist.render(context)))
+    return templates
+
+
 class KnockoutFormTemplate(Node):
     """ This template node is responsible for rendering <script> templates
-        for all children form of a given form.
-        TODO: Ensure templates are not rendered twice.
+        for all children form of a given form. Each template is only sent
+        once per response, even with several nested_form tags on the page.
+        When defer is True the templates are left for the
+        nested_form_templates tag instead.
     """
-    def __init__(self, form):
+    def __init__(self, form, defer=False):
         self.form_var = template.Variable(form)
+        self.defer = defer
 
     def render(self, context):
-        nodelist = NodeList()
         form = self.form_var.resolve(context)
-        child_forms = []
-        # recursively find all inline_form that need to get printed
-        while hasattr(form, "child_form"):
-            child_forms.append((form.child_form, form))
-            form = form.child_form()
-
-        """ 
-            All the nested forms we print out will have this general structure
-            - <div id='{form_name}_form_div' class='form-container'> - HtmlContent
-                - Fields from the parent form 
-                -  The inline form which prints the children and management form (hidden) 
-                - <div id='{form_name}_children_div' class='form-children'>
-                    --- Kids printed here ---
-                  </div>
-                - <div id='{form_name}_management_form_div' class='management-form-div'>
-                    - Management form (hidden)
-                    - Inline actions form (if one exists)
-                - </div>
-            - </div>
-        """
-
-        # Loop through each and get the knockout templates for each
-        for child_form, parent_form in child_forms:
-            child_form = child_form() if isinstance(child_form, type) else child_form
-            child_form.fields["delete_button"] = SubmitButtonField()
-            # Add knockoutjs bindings to the child form fields
-            for field_name, field in child_form.fields.iteritems():
-                attr = "{'id' : 'id_' + prefix + '-' + index + '-%s', 'name' : prefix + '-' + index + '-%s'}" % (field_name, field_name)
-                field.widget.attrs["data-bind"] = mark_safe("attr: %s" % attr)
-            form_name = get_form_name(child_form)
-            template_name = get_form_template_name(child_form)
-            context["child_%s" % form_name] = child_form
-            context["child_%s_helper" % form_name] = get_default_helper()
-
-            # print out the script for the template
-            nodelist.append(HtmlContent('<script type="text/html" id="%s">' % template_name))
-            form_container_attrs = "{'id': '%s_form_div' }" % get_form_name(child_form, prefix="' + prefix + '-' + index + '")
-            nodelist.append(HtmlContent('<div data-bind="attr: %s" class="form-container">' % mark_safe(form_container_attrs)))
-            nodelist.append(CrispyFormNode(form="child_%s" % form_name, 
-                helper="child_%s_helper" % form_name))
-            if hasattr(child_form, "inline_form"): # then print the management form as well
-                """ If our child has a child (e.g. building has tenants)
-                    then print the management form for it's child (tenant)
-                """
-                # first we need to actually print the div to hold the kids
-                form_children_attrs = "{'id': '%s_children_div' }" % \
-                    get_form_name(child_form, prefix="' + prefix + '-' + index +'")        
-                nodelist.append(HtmlContent("""
-                    <div data-bind="attr: %s" class="form-children"></div>
-                """ % mark_safe(form_children_attrs)))
-
-                management_form_div_class = get_management_form_div_name(parent_form, prefix="' + prefix + '-' + index + '")
-                management_form_div_attrs = "{'id' : '%s'}" % management_form_div_class
-                nodelist.append(HtmlContent("""
-                    <div data-bind="attr: %s" class='management-form-div'>
-                    """ % management_form_div_attrs))
-
-                formset = child_form.inline_form
-                grand_child_management_form = child_form.inline_form.management_form
-
-                # Tweak it and adds Knockout bindings 
-                parent_prefix = parent_form.inline_form.prefix
-                child_prefix = child_form.inline_form.prefix
-                fields = grand_child_management_form.fields
-                for field_name, field in fields.iteritems():
-                    attr = "{'id' : 'id_' + prefix + '-' + index + '-%s-%s', 'name' : prefix + '-' + index + '-%s-%s'}" % (child_prefix, field_name, child_prefix, field_name)
-                    if field_name == "TOTAL_FORMS":
-                        attr = "{'id' : 'id_' + prefix + '-' + index + '-%s-%s', 'name' : prefix + '-' + index + '-%s-%s', 'value': totalForms }" % (child_prefix, field_name, child_prefix, field_name)
-                    field.widget.attrs["data-bind"] = mark_safe("attr: %s" % attr)
-                context["child_%s_management_form" % form_name] = grand_child_management_form
-                context["child_%s_management_form_helper" % form_name] = get_default_helper()
-                nodelist.append(CrispyFormNode("child_%s_management_form" % form_name, 
-                    "child_%s_management_form_helper" % form_name))
-
-                if hasattr(formset, "actions_form") and \
-                        formset.actions_form is not None:
-                    inline_actions_form_name = "%s-inline_actions_form" % get_form_name(child_form)
-                    inline_actions_form_helper_name = "%s-helper" % inline_actions_form_name
-                    context[inline_actions_form_name] = formset.actions_form
-                    context[inline_actions_form_helper_name] = formset.actions_form().helper
-                    nodelist.append(CrispyFormNode(form=inline_actions_form_name, 
-                        helper=inline_actions_form_helper_name))
-                
-                nodelist.append(HtmlContent("</div>")) # end of the management form div
-            nodelist.append(HtmlContent("</div>")) # end of form-cotnainer
-
-            nodelist.append(HtmlContent("</script>"))
-        return nodelist.render(context)
+        return render_templates_once(form, context, defer=self.defer)
 
 
-def get_bindings(form):
-    if not hasattr(form, "inline_form"):
-        return []
+class NestedFormTemplatesNode(Node):
+    """ This is the node for the `nested_form_templates` tag. It prints the
+        <script> templates of all the nested_form tags rendered with
+        defer_templates so far, e.g. once at the end of the body.
+    """
 
-    formset = form.inline_form
-    form_name = get_form_name(form)
-    child_template_name = get_form_template_name(formset.form)
-    parent_form_div_class = "%s_form_div" % form_name
-    num_forms = len(formset.forms)
-    management_form_div_class = get_management_form_div_name(formset.parent_form)
-    prefix = formset.prefix
+    def render(self, context):
+        if is_streaming(context):
+            return add_stream_item(context, "templates")
+        return render_deferred_templates(context)
 
-    bindings = []
 
-    bindings.append(
-        """
-            // Management form for the children of %s
-            ko.applyBindings(new ManagementForm('%s', '%s', %s, '%s'), jQuery("#%s").get()[0]);
-        """ % (form_name, form_name, child_template_name, num_forms, prefix, management_form_div_class)
-    )
+def get_load_more_html(formset):
+    """ Returns the button that loads the next page of children of a formset
+        that only holds some of them (see NestedModelForm.child_limit).
+    """
+    if not getattr(formset, "has_more", False) or \
+            not isinstance(getattr(formset, "parent_form", None),
+                NestedModelForm):
+        return ""
+    parent = formset.instance
+    try:
+        url = reverse("child-forms", kwargs=dict(
+            model=parent._meta.object_name.lower(), pk=parent.pk))
+    except NoReverseMatch:
+        return ""
+    url = "%s?%s" % (url, urlencode({"prefix": formset.parent_form.prefix,
+        "limit": formset.child_limit}))
+    return '<input type="button" class="btn load-more" value="Load more" ' \
+        'data-url="%s" data-bind="click: loadMore, visible: canLoadMore">' % \
+        escape(url)
+
+def render_child_forms(formset, context):
+    """ Renders the forms of the given formset, without the children div
+        and the management form around them. This is used to send the
+        children that are loaded on demand.
+    """
+    nodelist = NodeList()
+    for child_index in range(len(formset.forms)):
+        child_form = formset.forms[child_index]
+        if not hasattr(child_form, "helper"):
+            child_form.helper = get_default_helper()
+        child_form_name = "%s_%s" % (get_form_name(child_form), child_index)
+        child_form_helper_name = "%s_helper" % child_form_name
+        context[child_form_name] = child_form
+        context[child_form_helper_name] = child_form.helper
+        process_helper(child_form.helper)
+        if hasattr(child_form, "inline_form"):
+            nodelist.append(NestedFormNode(child_form_name,
+                child_form_helper_name, top_level=False))
+        else:
+            nodelist.append(CrispyFormNode(child_form_name,
+                child_form_helper_name))
+    return nodelist.render(context)
+
+def get_binding_data(form):
+    """ Returns the arguments of the ManagementForm (see forms.js) of every
+        formset in the tree of the given form (or top level formset, e.g.
+        one of nested_formset_factory):
+        [parent form name, child template, number of forms, prefix,
+         management form div id, whether there are more children to load]
+    """
+    if isinstance(form, BaseFormSet):
+        formset = form
+        parent = getattr(formset, "parent_form", formset)
+    else:
+        formset = getattr(form, "inline_form", None)
+        parent = form
+    if formset is None:
+        return []
 
+    bindings = [[
+        get_form_name(parent),
+        get_form_template_name(formset.form),
+        len(formset.forms),
+        formset.prefix,
+        get_management_form_div_name(parent),
+        getattr(formset, "has_more", False),
+    ]]
     for child_form in formset.forms:
-        child_bindings = get_bindings(child_form)
-        for child_binding in child_bindings:
-            bindings.append(child_binding)
-
+        bindings.extend(get_binding_data(child_form))
     return bindings
 
+def to_script_json(data):
+    """ Dumps the data as compact JSON that is safe to print in a <script>
+        element.
+    """
+    return json.dumps(data, separators=(",", ":")).replace("</", "<\\/")
+
+def get_bindings(form):
+    """ Returns the JS that binds the management forms of the tree of the
+        given form: a single call of applyManagementForms (see forms.js)
+        with the data of get_binding_data.
+    """
+    return "applyManagementForms(%s);" % to_script_json(get_binding_data(form))
+
+
+_js_infos = {}
 
 def get_js_info(form):
-    """ Returns a list of assignments that indicate the name of the 
-        child template and child form name given a form name
+    """ Returns the assignment of childInfos, which gives the name of the
+        child template, the child form and the relation given a form name.
+        It only depends on the form classes so it is built once per tree.
     """
-    infos = {}
-    while hasattr(form, "child_form"):
-        info = dict(childTemplate="%s-template" % get_form_name(form.child_form),
-            childForm="%s" % get_form_name(form.child_form),
-            relName=form.inline_form.rel_name
-            )
-        infos[get_form_name(form.__class__)] = info
-        form = form.child_form()
-    return """
-        var childInfos = %s;
-    """ % json.dumps(infos)
+    key = (form.__class__, getattr(form, "child_form", None),
+        getattr(form, "child_actions_form", None))
+    js_info = _js_infos.get(key)
+    if js_info is None:
+        infos = {}
+        if isinstance(form, BaseFormSet):
+            # The levels of nested_formset_factory are linked by their
+            # nested_formset_class
+            formset_class = form.__class__
+            while getattr(formset_class, "nested_formset_class", None):
+                child = formset_class.nested_formset_class
+                infos[formset_class.form.__name__] = dict(
+                    childTemplate=get_form_template_name(child.form),
+                    childForm=child.form.__name__,
+                    relName=child.get_default_prefix(),
+                )
+                formset_class = child
+        else:
+            for level in get_form_schema(form):
+                if level.child is None:
+                    break
+                infos[level.form_name] = dict(
+                    childTemplate=level.child.template_name,
+                    childForm=level.child.form_name,
+                    relName=level.child.rel_name,
+                )
+        js_info = _js_infos.setdefault(key,
+            "var childInfos = %s;" % to_script_json(infos))
+    return js_info
 
 
 class NestedFormNodeJs(Node):
@@ -233,26 +508,110 @@ class NestedFormNodeJs(Node):
 
     def render(self, context):
         actual_form = self.form_var.resolve(context)
-        bindings = get_bindings(actual_form)
-        #bindings.reverse() # bind in reverse order ...
-        nodelist = NodeList()
+        # Add the script to activate this form
+        return "<script>%s$(document).ready(function(){%s});</script></div>" % (
+            get_js_info(actual_form), get_bindings(actual_form))
 
-        js_info = get_js_info(actual_form)
 
-        # Add the script to activate this form
-        nodelist.append(HtmlContent("""
-            <script> 
-                %s 
+def iter_nested_form(form, helper, context, defer_templates=False):
+    """ Yields the exact same markup NestedFormNode renders for the given
+        top level form (or formset), one fragment at a time. helper is the
+        (resolved) helper given to the tag, if any.
+    """
+    key = get_fragment_cache_key(form, helper, context)
+    html = get_cached_fragment(key, context) if key else None
+    if html is not None:
+        yield html
+    elif key:
+        token = context.get("csrf_token")
+        fragments = []
+        with csrf_token_placeholder(context):
+            for fragment in iter_form_fragments(form, helper, context):
+                fragments.append(fragment)
+                yield restore_csrf_token(fragment, token)
+        set_cached_fragment(key, "".join(fragments))
+    else:
+        for fragment in iter_form_fragments(form, helper, context):
+            yield fragment
+    yield render_templates_once(form, context, defer=defer_templates)
+
+def iter_form_fragments(form, helper, context):
+    """ Walks the tree of the given top level form (or formset) without any
+        recursion and yields its markup (without the <script> templates).
+        Every form is rendered by the same two crispy nodes, pushing the
+        form and its helper onto the context only while it is rendered.
+    """
+    form_node = CrispyFormNode("nest_form", "nest_form_helper")
+    helperless_form_node = CrispyFormNode("nest_form", None)
+
+    def render_crispy(form, helper):
+        context.update({"nest_form": form, "nest_form_helper": helper})
+        try:
+            if helper is None:
+                return helperless_form_node.render(context)
+            return form_node.render(context)
+        finally:
+            context.pop()
 
-                $(document).ready(function(){
-                    // new ManagementForm(parentForm, childTemplate, initialForms);
-                    %s
-                });
-            </script>
-            """ % (js_info, "\n".join(bindings))))
-        nodelist.append(HtmlContent("</div>"))
+    is_formset = issubclass(form.__class__, BaseFormSet)
+    actual_helper = helper if helper is not None else \
+        getattr(form, "helper", None)
+    if actual_helper is not None and actual_helper.form_tag:
+        actual_helper.form_tag = False
+
+    # Each item is ("html", html), ("crispy", form, helper),
+    # ("form", form, helper) or ("formset", formset)
+    stack = [("formset", form) if is_formset else ("form", form, helper)]
+    while stack:
+        item = stack.pop()
+        kind = item[0]
+        if kind == "html":
+            yield item[1]
+        elif kind == "crispy":
+            yield render_crispy(item[1], item[2])
+        elif kind == "form":
+            actual_form, actual_helper = item[1], item[2]
+            items = [
+                ("html", "<div id='%s_form_div' class='form-container'>" %
+                    get_form_name(actual_form)),
+                ("crispy", actual_form, actual_helper),
+            ]
+            if hasattr(actual_form, "inline_form"):
+                actual_form.inline_form.parent_form = actual_form
+                items.append(("formset", actual_form.inline_form))
+            items.append(("html", "</div>"))
+            stack.extend(reversed(items))
+        else:
+            formset = item[1]
+            form_name = get_form_name(formset.parent_form)
+            items = [("html", "<div id='%s_children_div' class='form-children'>" %
+                form_name)]
+            for child_form in formset.forms:
+                if not hasattr(child_form, "helper"):
+                    child_form.helper = get_default_helper()
+                process_helper(child_form.helper)
+                kind = "form" if hasattr(child_form, "inline_form") else "crispy"
+                items.append((kind, child_form, child_form.helper))
+            items.append(("html", "</div>"))
 
-        return nodelist.render(context)
+            management_form_helper = FormHelper()
+            management_form_helper.form_tag = False
+            management_form_helper.disable_csrf = True
+            management_form = formset.management_form
+            fields = management_form.fields
+            fields["TOTAL_FORMS"].widget.attrs["data-bind"] = "value: totalForms"
+            fields["INITIAL_FORMS"].widget.attrs["data-bind"] = "value: initialForms"
+            fields["MAX_NUM_FORMS"].widget.attrs["data-bind"] = "value: maxForms"
+            items.append(("html", "<div id='%s' class='management-form-div'>" %
+                get_management_form_div_name(formset.parent_form)))
+            items.append(("crispy", management_form, management_form_helper))
+            if hasattr(formset, "actions_form") and \
+                    formset.actions_form is not None:
+                items.append(("crispy", formset.actions_form,
+                    formset.actions_form().helper))
+            items.append(("html", get_load_more_html(formset)))
+            items.append(("html", "</div>"))
+            stack.extend(reversed(items))
 
 
 class NestedFormNode(Node):
@@ -260,8 +619,9 @@ class NestedFormNode(Node):
         printing out the parent form, any children form, management form (hidden)
     """
 
-    def __init__(self, form, helper, top_level=True):
+    def __init__(self, form, helper, top_level=True, defer_templates=False):
         self.top_level = top_level
+        self.defer_templates = defer_templates
         self.form = form
         self.helper = helper
         self.form_var = template.Variable(form)
@@ -276,8 +636,39 @@ class NestedFormNode(Node):
         """
         top_level = self.top_level
         actual_form = self.form_var.resolve(context)
+        if top_level and is_streaming(context):
+            helper = self.helper_var.resolve(context) if self.helper else None
+            return add_stream_item(context, "form", actual_form, helper,
+                self.defer_templates)
+        if top_level and getattr(settings, "NEST_ITERATIVE_RENDER", False):
+            helper = self.helper_var.resolve(context) if self.helper else None
+            with tracing.span("render", actual_form):
+                return mark_safe("".join(iter_nested_form(actual_form, helper,
+                    context, defer_templates=self.defer_templates)))
+        if top_level:
+            helper = self.helper_var.resolve(context) if self.helper else None
+            key = get_fragment_cache_key(actual_form, helper, context)
+            html = get_cached_fragment(key, context) if key else None
+            if html is None and key:
+                with csrf_token_placeholder(context):
+                    html = self.render_form(context, actual_form)
+                set_cached_fragment(key, html)
+                html = restore_csrf_token(html, context.get("csrf_token"))
+            elif html is None:
+                html = self.render_form(context, actual_form)
+            return mark_safe(html + render_templates_once(actual_form,
+                context, defer=self.defer_templates))
+        return self.render_form(context, actual_form)
+
+    def render_form(self, context, actual_form):
+        """ Renders the given form or formset and everything nested in it
+            (but not the <script> templates).
+        """
         is_formset = issubclass(actual_form.__class__, BaseFormSet)
-        form_name = get_form_name(actual_form) if not is_formset else get_form_name(actual_form.parent_form)
+        # A top level formset (e.g. of nested_formset_factory) has no parent
+        # form, it stands in for it
+        parent_form = getattr(actual_form, "parent_form", actual_form)
+        form_name = get_form_name(actual_form) if not is_formset else get_form_name(parent_form)
         #print("== Rendering %s (Formset: %s) " % (form_name, is_formset))
         if self.helper is not None:
             actual_helper = self.helper_var.resolve(context)
@@ -361,7 +752,7 @@ class NestedFormNode(Node):
             # Let Crispy handle the printing of this...
             #print("Adding %s management_form to the node list" % form_name)
             # Add a div for the management form
-            management_form_div_class = get_management_form_div_name(actual_form.parent_form)
+            management_form_div_class = get_management_form_div_name(parent_form)
             nodelist.append(HtmlContent("<div id='%s' class='management-form-div'>" % management_form_div_class))
             nodelist.append(CrispyFormNode("%s_management_form" % form_name,
                 "%s_management_form_helper" % form_name))
@@ -375,6 +766,7 @@ class NestedFormNode(Node):
                 context[inline_actions_form_helper_name] = actual_form.actions_form().helper
                 nodelist.append(CrispyFormNode(form=inline_actions_form_name, 
                     helper=inline_actions_form_helper_name))
+            nodelist.append(HtmlContent(get_load_more_html(actual_form)))
             nodelist.append(HtmlContent("</div>"))
 
         else: # not a formset
@@ -394,21 +786,31 @@ class NestedFormNode(Node):
             # we didn't add this if it was a formset
             nodelist.append(HtmlContent("</div>")) # for the form
 
-        if top_level:
-            # print out ALL the script templates
-            nodelist.append(KnockoutFormTemplate(self.form))
-
-        return nodelist.render(context)
+        with tracing.span("render", actual_form) as span:
+            if is_formset:
+                span.rows = len(actual_form.forms)
+            return nodelist.render(context)
 
 @register.tag
 def nested_form(parser, token):
+    """ {% nested_form form [helper] [defer_templates] %}
+        With defer_templates the <script> templates are printed by a later
+        {% nested_form_templates %} instead.
+    """
     tokens = token.split_contents()
+    defer_templates = tokens[-1] == "defer_templates"
+    if defer_templates:
+        tokens.pop()
     form = tokens.pop(1) # pop the 2nd item, skip the tag name
     try:
         helper = tokens.pop(1)
     except IndexError:
         helper = None
-    return NestedFormNode(form, helper)
+    return NestedFormNode(form, helper, defer_templates=defer_templates)
+
+@register.tag
+def nested_form_templates(parser, token):
+    return NestedFormTemplatesNode()
 
 @register.tag
 def nested_form_js(parser, token):
@@ -1,11 +1,77 @@
 """
-This file demonstrates writing tests using the unittest module. These will pass
-when you run "manage.py test".
-
-Replace this with more appropriate tests for your application.
+Tests for the nested forms, their template tags, commands and views.
 """
 
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connections
+from django.template import Context, Template
 from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils.six import StringIO
+
+from nest.forms import (BlockForm, BuildingForm, TenantForm, FurnitureForm,
+    BuildingActionsForm, get_inline_formset_class, get_nested_queryset,
+    get_schema, get_form_schema, nested_formset_factory, DataIndex)
+from nest.bundle import MANIFEST_NAME, write_bundle
+from nest.benchmarks import (BENCHMARKS, get_form_data, run_benchmarks,
+    run_rewrite_benchmark, rewrite_template_chain)
+from nest.bulk import delete_trees
+from nest.jobs import serialize_tree, save_tree_data
+from nest.listing import fetch, get_hierarchy_page, load_trees
+from nest.models import Block, Building, Tenant, Furniture, Lease
+from nest.tracing import Tracer
+
+
+def create_block(buildings=2, tenants=2, furniture=2):
+    """
+    Creates a block with the given number of children on every level.
+    """
+    block = Block.objects.create(name="Block")
+    for i in range(buildings):
+        building = Building.objects.create(name="Building %s" % i, block=block)
+        for j in range(tenants):
+            tenant = Tenant.objects.create(first_name="Tenant %s" % j,
+                last_name="Building %s" % i, building=building)
+            for k in range(furniture):
+                Furniture.objects.create(name="Chair %s" % k, tenant=tenant)
+    return block
+
+
+def get_management_data(prefix, total, initial=0):
+    return {
+        "%s-TOTAL_FORMS" % prefix: str(total),
+        "%s-INITIAL_FORMS" % prefix: str(initial),
+        "%s-MAX_NUM_FORMS" % prefix: "1000",
+    }
+
+
+def get_new_block_data(buildings=2, tenants=2, furniture=2):
+    """
+    Returns the POST data for a brand new block with the given number of
+    children on every level.
+    """
+    data = {"name": "Block"}
+    data.update(get_management_data("buildings", buildings))
+    for i in range(buildings):
+        building = "buildings-%s" % i
+        data["%s-name" % building] = "Building %s" % i
+        data.update(get_management_data("%s-tenants" % building, tenants))
+        for j in range(tenants):
+            tenant = "%s-tenants-%s" % (building, j)
+            data["%s-first_name" % tenant] = "Tenant %s" % j
+            data["%s-last_name" % tenant] = "Building %s" % i
+            data.update(get_management_data("%s-furniture" % tenant,
+                furniture))
+            for k in range(furniture):
+                data["%s-furniture-%s-name" % (tenant, k)] = "Chair %s" % k
+    return data
 
 
 class SimpleTest(TestCase):
@@ -14,3 +80,732 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+class SchemaTest(TestCase):
+    def test_schema_of_block_form(self):
+        """
+        Tests that the schema of a form class is read off the classes.
+        """
+        schema = get_schema(BlockForm)
+        self.assertEqual([level.form_class for level in schema],
+            [BlockForm, BuildingForm, TenantForm, FurnitureForm])
+        self.assertEqual([level.rel_name for level in schema[1:]],
+            ["buildings", "tenants", "furniture"])
+        self.assertEqual(schema[1].actions_form_class, BuildingActionsForm)
+        self.assertEqual(schema[2].template_name, "TenantForm-template")
+        self.assertTrue(schema[0].child is schema[1])
+        self.assertTrue(get_form_schema(BlockForm()) is schema)
+
+
+class FormTemplatesCommandTest(TestCase):
+    def test_child_forms_found_without_instantiating(self):
+        """
+        Tests that the child forms are found from the class declarations.
+        """
+        from nest import forms
+        from nest.management.commands.form_templates import find_child_forms
+        items = find_child_forms([forms])
+        self.assertTrue(("nest.forms", "BuildingForm", "nest.forms",
+            "BlockForm") in items)
+        self.assertTrue(("nest.forms", "FurnitureForm", "nest.forms",
+            "TenantForm") in items)
+
+    def test_command_writes_the_templates(self):
+        """
+        Tests that the command writes the Dust templates, their manifest and
+        the bundle, and leaves them alone when nothing changed.
+        """
+        output_dir = tempfile.mkdtemp()
+        static_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, output_dir)
+        self.addCleanup(shutil.rmtree, static_dir)
+
+        def run():
+            stdout = StringIO()
+            call_command("form_templates", jobs=1, output_dir=output_dir,
+                static_dir=static_dir, stdout=stdout)
+            return stdout.getvalue()
+
+        output = run()
+        names = ["BuildingForm-form.form", "TenantForm-form.form",
+            "FurnitureForm-form.form"]
+        for name in names:
+            with open(os.path.join(output_dir, name)) as f:
+                html = f.read()
+            self.assertTrue("{index}" in html)
+            self.assertFalse("\n" in html)
+        with open(os.path.join(output_dir, "manifest.json")) as f:
+            self.assertEqual(sorted(json.load(f)), sorted(names))
+        with open(os.path.join(static_dir, "js", MANIFEST_NAME)) as f:
+            bundle = json.load(f)
+        self.assertTrue(os.path.exists(os.path.join(static_dir,
+            bundle["file"])))
+        self.assertTrue("Generated template for: BuildingForm-form" in output)
+        self.assertTrue("Template for BuildingForm-form is up to date" in run())
+
+
+class RewriteTemplateTest(TestCase):
+    def test_same_as_the_regex_chain(self):
+        """
+        Tests that the single pass rewrite gives the same templates as the
+        chain of re.sub it replaced.
+        """
+        from nest.management.commands.form_templates import rewrite_template
+        html = ('\t<div id="div_id_name">\n<input id="id_name" name="name">'
+            '<input name="id_x"><input name="div_id_y" data-name="z"> \n')
+        self.assertEqual(rewrite_template(html, "tenants"),
+            rewrite_template_chain(html, "tenants"))
+        result = run_rewrite_benchmark(repeat=1, number=1)
+        self.assertTrue(result["identical"])
+
+
+class FormsetRegistryTest(TestCase):
+    def test_formset_class_is_reused(self):
+        """
+        Tests that the inline formset class is only built once per
+        parent/child pair.
+        """
+        first = BlockForm().inline_form.__class__
+        second = BlockForm().inline_form.__class__
+        self.assertTrue(first is second)
+        self.assertTrue(first is get_inline_formset_class(Block, Building,
+            BuildingForm))
+
+
+class NestedFormsetFactoryTest(TestCase):
+    def test_four_levels(self):
+        """
+        Tests that the factory nests any number of levels, builds the
+        classes only once and that the formset saves the whole tree.
+        """
+        FormSet = nested_formset_factory(Block, Building, Tenant, Furniture,
+            extra=0)
+        self.assertTrue(FormSet is nested_formset_factory(Block, Building,
+            Tenant, Furniture, extra=0))
+        self.assertEqual(FormSet.nested_formset_class.model, Tenant)
+        self.assertEqual(
+            FormSet.nested_formset_class.nested_formset_class.model, Furniture)
+
+        block = Block.objects.create(name="Block")
+        formset = FormSet(get_new_block_data(buildings=2, tenants=2,
+            furniture=3), instance=block)
+        self.assertTrue(formset.is_valid())
+        formset.save()
+        self.assertEqual(Tenant.objects.filter(building__block=block).count(), 4)
+        self.assertEqual(Furniture.objects.filter(
+            tenant__building__block=block).count(), 12)
+
+    def test_formset_is_rendered(self):
+        """
+        Tests that the formsets of nested_formset_factory render with the
+        nested_form and nested_form_js tags.
+        """
+        FormSet = nested_formset_factory(Block, Building, Tenant, Furniture,
+            extra=0)
+        block = create_block(buildings=2, tenants=2, furniture=1)
+        formset = FormSet(instance=block)
+        template = Template("{% load nested_crispy %}"
+            "{% nested_form formset %}{% nested_form_js formset %}")
+        html = template.render(Context({"formset": formset}))
+        self.assertTrue("Tenant 1" in html)
+        self.assertTrue("Chair 0" in html)
+        start = html.index("applyManagementForms(") + len("applyManagementForms(")
+        bindings = json.loads(html[start:html.index(");", start)])
+        # the buildings, their 2 tenant formsets and 4 furniture formsets
+        self.assertEqual(len(bindings), 7)
+        self.assertEqual(bindings[0][3], formset.prefix)
+        self.assertEqual(bindings[1][3], formset.forms[0].inline_form.prefix)
+
+
+class NestedQuerysetTest(TestCase):
+    def test_one_query_per_level(self):
+        """
+        Tests that building the whole nested form only costs one query per
+        level of the tree.
+        """
+        block = create_block(buildings=3, tenants=3, furniture=3)
+        with self.assertNumQueries(4):
+            block = get_nested_queryset(BlockForm).get(pk=block.pk)
+            form = BlockForm(instance=block)
+            building_form = form.inline_form.forms[0]
+            tenant_form = building_form.inline_form.forms[0]
+        self.assertEqual(len(form.inline_form.forms), 3)
+        self.assertEqual(len(tenant_form.inline_form.forms), 3)
+
+
+class HierarchyListingTest(TestCase):
+    def test_one_query_per_level(self):
+        """
+        Tests that a page of blocks is listed with a query per level, and
+        one to count them, however big the trees are.
+        """
+        for i in range(3):
+            create_block(buildings=2, tenants=2, furniture=2)
+        with self.assertNumQueries(5):
+            page = get_hierarchy_page(BlockForm, 1, per_page=2)
+            blocks = page.object_list
+            self.assertEqual(len(blocks), 2)
+            self.assertEqual(blocks[0].buildings_count, 2)
+            building = blocks[0].buildings.all()[0]
+            self.assertEqual(building.tenants_count, 2)
+            self.assertEqual(building.tenants.all()[0].furniture_count, 2)
+        self.assertEqual(get_hierarchy_page(BlockForm, "last", 2).number, 1)
+        self.assertEqual(get_hierarchy_page(BlockForm, 9, 2).number, 2)
+
+
+class LoadTreesTest(TestCase):
+    def test_levels_loaded_off_the_top_rows(self):
+        """
+        Tests that load_trees loads every level with one query and that the
+        nested forms don't query them again.
+        """
+        for i in range(2):
+            create_block(buildings=2, tenants=2, furniture=2)
+        blocks = list(Block.objects.order_by("pk"))
+        # The test database is in-memory SQLite, which the threads of the
+        # pool don't see, so this runs the queries in here (see
+        # can_share_database); test_fetch_keeps_the_connection covers what
+        # the threads run
+        with self.assertNumQueries(3):
+            load_trees(BlockForm, blocks, threads=3)
+        with self.assertNumQueries(0):
+            form = BlockForm(instance=blocks[1])
+            buildings = form.inline_form.forms
+            self.assertEqual(len(buildings), 2)
+            tenants = buildings[0].inline_form.forms
+            self.assertEqual(len(tenants[1].inline_form.forms), 2)
+            self.assertEqual(tenants[1].instance.building.block, blocks[1])
+
+    def test_fetch_keeps_the_connection(self):
+        """
+        Tests that the queries of the loader threads leave their connection
+        open for the next one.
+        """
+        block = create_block(buildings=2, tenants=0, furniture=0)
+        buildings = fetch(Building.objects.filter(block=block))
+        self.assertEqual(len(buildings), 2)
+        self.assertTrue(connections[Building.objects.db].connection
+            is not None)
+
+    @override_settings(NEST_LOADER_THREADS=3)
+    def test_edit_page(self):
+        """
+        Tests that the edit page works with the levels loaded by load_trees.
+        """
+        block = create_block(buildings=2, tenants=1, furniture=1)
+        response = self.client.get("/edit/block/%s/" % block.pk)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get("/edit/block/%s/" % (
+            block.pk + 1)).status_code, 404)
+
+
+class BulkSaveTest(TestCase):
+    def test_bulk_save_new_tree(self):
+        """
+        Tests that a bulk save creates the whole tree.
+        """
+        form = BlockForm(get_new_block_data(buildings=2, tenants=3,
+            furniture=4))
+        self.assertTrue(form.is_valid())
+        block = form.save(bulk=True)
+        self.assertEqual(block.buildings.count(), 2)
+        self.assertEqual(Tenant.objects.filter(building__block=block).count(), 6)
+        self.assertEqual(Furniture.objects.filter(
+            tenant__building__block=block).count(), 24)
+        self.assertEqual(form.save_counts["created"]["nest.Furniture"], 24)
+
+    def test_bulk_save_updates_and_deletes(self):
+        """
+        Tests that a bulk save updates changed rows and deletes the rows
+        flagged with DELETE.
+        """
+        block = create_block(buildings=2, tenants=1, furniture=1)
+        buildings = list(block.buildings.order_by("pk"))
+        data = {"name": "Renamed"}
+        data.update(get_management_data("buildings", 2, initial=2))
+        for i, building in enumerate(buildings):
+            prefix = "buildings-%s" % i
+            data["%s-id" % prefix] = str(building.pk)
+            data["%s-name" % prefix] = "Renamed %s" % i
+            data.update(get_management_data("%s-tenants" % prefix, 0))
+        data["buildings-1-DELETE"] = "on"
+        form = BlockForm(data, instance=block)
+        self.assertTrue(form.is_valid())
+        form.save(bulk=True)
+        self.assertEqual(Block.objects.get(pk=block.pk).name, "Renamed")
+        self.assertEqual(list(block.buildings.values_list("name", flat=True)),
+            ["Renamed 0"])
+
+
+class DeleteTreesTest(TestCase):
+    def test_delete_trees(self):
+        """
+        Tests that the whole trees of the given rows are deleted, and only
+        those.
+        """
+        blocks = [create_block(buildings=2, tenants=2, furniture=2)
+            for i in range(3)]
+        # A count and a DELETE per level, except for the tenants, which the
+        # leases point at: Django's collector fetches them, deletes their
+        # leases and furniture and then them
+        with self.assertNumQueries(11):
+            counts = delete_trees(BlockForm, [block.pk for block in blocks[:2]])
+        self.assertEqual(counts["deleted"], {"nest.Block": 2,
+            "nest.Building": 4, "nest.Tenant": 8, "nest.Furniture": 16})
+        self.assertEqual(list(Block.objects.values_list("pk", flat=True)),
+            [blocks[2].pk])
+        self.assertEqual(Furniture.objects.count(), 8)
+
+    def test_rows_outside_the_schema_are_deleted(self):
+        """
+        Tests that the rows of models the nested forms don't know about
+        still go along with the rows they point at.
+        """
+        blocks = [create_block(buildings=1, tenants=2, furniture=1)
+            for i in range(2)]
+        for tenant in Tenant.objects.all():
+            Lease.objects.create(tenant=tenant)
+        counts = delete_trees(BlockForm, [blocks[0].pk])
+        self.assertEqual(counts["deleted"]["nest.Tenant"], 2)
+        self.assertEqual(list(Lease.objects.values_list("tenant__building__block",
+            flat=True)), [blocks[1].pk] * 2)
+
+    def test_detach_view(self):
+        """
+        Tests that detaching keeps the children without a parent.
+        """
+        block = create_block(buildings=2, tenants=1, furniture=1)
+        response = self.client.post("/delete/block/",
+            {"pk": [block.pk], "detach": "1"})
+        counts = json.loads(response.content.decode("utf-8"))
+        self.assertEqual(counts["detached"], {"nest.Building": 2})
+        self.assertEqual(counts["deleted"], {"nest.Block": 1})
+        self.assertEqual(Building.objects.filter(block=None).count(), 2)
+        self.assertEqual(Tenant.objects.count(), 2)
+
+
+class JsonSubmissionTest(TestCase):
+    def test_json_tree_is_saved(self):
+        """
+        Tests that a JSON submission of a new block creates the same tree as
+        the flat prefixed fields do.
+        """
+        tree = {"name": "Block", "buildings": [
+            {"name": "Building %s" % i, "tenants": [
+                {"first_name": "Tenant", "last_name": "Building %s" % i,
+                    "furniture": [{"name": "Chair"}, {"name": "Table"}]}]}
+            for i in range(2)]}
+        response = self.client.post("/new-block/", json.dumps(tree),
+            content_type="application/json")
+        self.assertEqual(response.status_code, 302)
+        block = Block.objects.get()
+        self.assertEqual(block.buildings.count(), 2)
+        self.assertEqual(Furniture.objects.filter(
+            tenant__building__block=block).count(), 4)
+
+    def test_existing_rows_come_first(self):
+        """
+        Tests that the rows with an id are the initial forms.
+        """
+        block = create_block(buildings=1, tenants=0, furniture=0)
+        building = block.buildings.get()
+        form = BlockForm(instance=block, json_data={"name": "Block",
+            "buildings": [{"name": "New"}, None,
+                {"id": building.pk, "name": "Renamed", "DELETE": False}]})
+        self.assertEqual(form.data["buildings-TOTAL_FORMS"], "2")
+        self.assertEqual(form.data["buildings-INITIAL_FORMS"], "1")
+        self.assertEqual(form.data["buildings-0-name"], "Renamed")
+        self.assertTrue(form.is_valid())
+        form.save()
+        self.assertEqual(sorted(block.buildings.values_list("name",
+            flat=True)), ["New", "Renamed"])
+
+    def test_children_must_be_a_list(self):
+        """
+        Tests that children sent as anything but a list are a bad request.
+        """
+        for buildings in (5, "abc", {"name": "Building"}):
+            response = self.client.post("/new-block/", json.dumps({
+                "name": "Block", "buildings": buildings}),
+                content_type="application/json")
+            self.assertEqual(response.status_code, 400)
+        self.assertEqual(Block.objects.count(), 0)
+
+
+class DataIndexTest(TestCase):
+    def test_formset_prefix(self):
+        """
+        Tests that keys are filed under the formset they belong to.
+        """
+        self.assertEqual(DataIndex.get_formset_prefix(
+            "buildings-0-tenants-1-first_name"), "buildings-0-tenants")
+        self.assertEqual(DataIndex.get_formset_prefix(
+            "buildings-0-tenants-TOTAL_FORMS"), "buildings-0-tenants")
+        self.assertEqual(DataIndex.get_formset_prefix("buildings-1-id"),
+            "buildings")
+        self.assertEqual(DataIndex.get_formset_prefix("name"), None)
+
+    @override_settings(NEST_DATA_INDEX_THRESHOLD=0)
+    def test_formsets_get_their_own_data(self):
+        """
+        Tests that every formset is bound to its own keys only and that the
+        tree is still saved.
+        """
+        form = BlockForm(get_new_block_data(buildings=2, tenants=2,
+            furniture=2))
+        self.assertFalse("name" in form.inline_form.data)
+        tenants = form.inline_form.forms[1].inline_form
+        self.assertEqual(len(tenants.data), 3 + 2 * 2)
+        self.assertTrue(all(key.startswith("buildings-1-tenants-")
+            for key in tenants.data))
+        self.assertTrue(form.is_valid())
+        block = form.save()
+        self.assertEqual(Furniture.objects.filter(
+            tenant__building__block=block).count(), 8)
+
+
+@override_settings(NEST_BACKGROUND_SAVE=True, NEST_BACKGROUND_WORKERS=0)
+class BackgroundSaveTest(TestCase):
+    def setUp(self):
+        cache.clear()
+
+    def test_new_block_is_saved_by_a_job(self):
+        """
+        Tests that the view answers with a job which saves the whole tree.
+        """
+        response = self.client.post("/new-block/",
+            get_new_block_data(buildings=2, tenants=1, furniture=2))
+        self.assertEqual(response.status_code, 202)
+        data = json.loads(response.content.decode("utf-8"))
+        job = json.loads(self.client.get(data["status"]).content.decode(
+            "utf-8"))
+        self.assertEqual(job["status"], "done")
+        block = Block.objects.get(pk=job["pk"])
+        self.assertEqual(Furniture.objects.filter(
+            tenant__building__block=block).count(), 4)
+        self.assertEqual(job["counts"]["created"]["nest.Tenant"], 2)
+
+    def test_tree_is_plain_data(self):
+        """
+        Tests that the captured tree only holds the changed rows, as plain
+        data.
+        """
+        block = create_block(buildings=2, tenants=1, furniture=1)
+        data = get_form_data(BlockForm(instance=block))
+        building = block.buildings.order_by("pk")[1]
+        data["buildings-1-name"] = "Renamed"
+        form = BlockForm(data, instance=block)
+        self.assertTrue(form.is_valid())
+        tree = json.loads(json.dumps(serialize_tree(form)))
+        self.assertEqual(tree["fields"], {})
+        self.assertEqual(tree["children"], [{"model": "nest.Building",
+            "pk": building.pk, "fk": "block_id", "delete": False,
+            "fields": {"name": "Renamed"}, "children": []}])
+        save_tree_data(tree)
+        self.assertEqual(Building.objects.get(pk=building.pk).name,
+            "Renamed")
+
+
+class SaveLoggingTest(TestCase):
+    def test_save_is_logged_once(self):
+        """
+        Tests that saving a tree logs one record with the counts per model.
+        """
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logger = logging.getLogger("nest.forms")
+        old_level = logger.level
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        try:
+            form = BlockForm(get_new_block_data(buildings=2, tenants=2,
+                furniture=1))
+            self.assertTrue(form.is_valid())
+            form.save()
+        finally:
+            logger.removeHandler(handler)
+            logger.setLevel(old_level)
+        self.assertEqual(len(records), 1)
+        counts = records[0].nest_save_counts
+        self.assertEqual(counts["created"]["nest.Building"], 2)
+        self.assertEqual(counts["created"]["nest.Furniture"], 4)
+
+    def test_bulk_save_deletes_nothing(self):
+        """
+        Tests that a bulk save doesn't log its rows as being deleted.
+        """
+        records = []
+        handler = logging.Handler()
+        handler.emit = records.append
+        logger = logging.getLogger("nest.forms")
+        old_level = logger.level
+        logger.addHandler(handler)
+        logger.setLevel(logging.DEBUG)
+        try:
+            form = BlockForm(get_new_block_data(buildings=1, tenants=1,
+                furniture=1))
+            self.assertTrue(form.is_valid())
+            form.save(bulk=True)
+        finally:
+            logger.removeHandler(handler)
+            logger.setLevel(old_level)
+        self.assertFalse([record for record in records
+            if "being deleted" in record.getMessage()])
+
+
+class ChangedOnlyTest(TestCase):
+    def test_only_changed_rows_are_validated(self):
+        """
+        Tests that with changed_only, the rows that weren't touched skip
+        validation and the edited row still gets saved.
+        """
+        block = create_block(buildings=2, tenants=2, furniture=1)
+        data = get_form_data(BlockForm(instance=block))
+        data["buildings-1-tenants-0-first_name"] = "Changed"
+        form = BlockForm(data, instance=block)
+        self.assertTrue(form.is_valid(changed_only=True))
+        buildings = form.inline_form.forms
+        self.assertEqual(buildings[0].cleaned_data, {})
+        self.assertEqual(buildings[1].inline_form.forms[1].cleaned_data, {})
+        form.save(changed_only=True)
+        self.assertEqual(Tenant.objects.filter(first_name="Changed").count(), 1)
+        # Saving didn't clean the untouched subtrees after all
+        self.assertTrue(buildings[0].inline_form._errors is None)
+        self.assertTrue(buildings[1].inline_form.forms[1].inline_form._errors
+            is None)
+
+
+class BenchmarkTest(TestCase):
+    def test_benchmarks_run(self):
+        """
+        Tests that the benchmarks run and report their queries.
+        """
+        results = run_benchmarks(widths=(2, 1, 1), repeat=1)
+        self.assertEqual([result["name"] for result in results],
+            [name for name, setup, run in BENCHMARKS])
+        construct = results[0]
+        self.assertEqual(construct["rows"], 7)
+        self.assertTrue(construct["queries"] > 0)
+        # Either measured or explained
+        self.assertTrue(construct["peak_memory"] is not None or
+            "peak_memory_unavailable" in construct)
+        self.assertEqual(Block.objects.count(), 0)
+
+
+class TracingTest(TestCase):
+    def test_levels_are_traced(self):
+        """
+        Tests that a tracer records the construction of every level.
+        """
+        block = create_block(buildings=2, tenants=1, furniture=1)
+        with Tracer() as tracer:
+            BlockForm(instance=block)
+        report = dict(((row["operation"], row["level"]), row)
+            for row in tracer.report())
+        self.assertEqual(report[("construct", 0)]["rows"], 2)
+        self.assertEqual(report[("construct", 1)]["calls"], 2)
+        self.assertEqual(report[("construct", 2)]["form"], "TenantForm")
+
+    def test_trace_header(self):
+        """
+        Tests that the trace totals of a request go into a header.
+        """
+        block = create_block(buildings=1, tenants=1, furniture=1)
+        url = "/edit/block/%s/" % block.pk
+        self.assertFalse(self.client.get(url).has_header("X-Nest-Trace"))
+        with override_settings(NEST_TRACING=True):
+            response = self.client.get(url)
+        summary = json.loads(response["X-Nest-Trace"])
+        self.assertTrue("construct" in summary)
+        self.assertTrue("render" in summary)
+
+
+class FormTemplateCacheTest(TestCase):
+    def test_templates_rendered_once(self):
+        """
+        Tests that the knockout templates are served from the cache and that
+        the CSRF token of each request is kept.
+        """
+        from nest.templatetags.nested_crispy import (render_form_templates,
+            template_cache)
+        template_cache.clear()
+        first = render_form_templates(BlockForm(), Context({"csrf_token": "a"}))
+        self.assertEqual(len(template_cache), 1)
+        second = render_form_templates(BlockForm(), Context({"csrf_token": "b"}))
+        self.assertEqual(len(template_cache), 1)
+        self.assertTrue('id="BuildingForm-template"' in first)
+        self.assertEqual(first.replace("'a'", "'b'"), second)
+
+    def test_token_found_in_the_markup(self):
+        """
+        Tests that a CSRF token that also shows up elsewhere in the markup
+        only ends up where the token goes.
+        """
+        from nest.templatetags.nested_crispy import (render_form_templates,
+            template_cache)
+        template_cache.clear()
+        first = render_form_templates(BlockForm(), Context({"csrf_token": "x"}))
+        second = render_form_templates(BlockForm(),
+            Context({"csrf_token": "div"}))
+        self.assertTrue("<div" in second)
+        self.assertEqual(first.replace("value='x'", "value='div'"), second)
+
+    def test_templates_sent_once_per_response(self):
+        """
+        Tests that several nested_form tags on one page only send each
+        template once, and that they can be deferred to the end of the page.
+        """
+        template = Template("{% load nested_crispy %}"
+            "{% nested_form first defer_templates %}"
+            "{% nested_form second defer_templates %}"
+            "<end>{% nested_form_templates %}")
+        html = template.render(Context({"first": BlockForm(),
+            "second": BlockForm(prefix="second")}))
+        self.assertEqual(html.count('id="TenantForm-template"'), 1)
+        self.assertTrue(html.index("<end>") < html.index("TenantForm-template"))
+
+
+class FragmentCacheTest(TestCase):
+    def test_fragment_is_invalidated_by_save(self):
+        """
+        Tests that the markup of an unbound form is served from the fragment
+        cache until the tree is saved through a nested form.
+        """
+        cache.clear()
+        block = create_block(buildings=1, tenants=1, furniture=1)
+        template = Template("{% load nested_crispy %}{% nested_form form %}")
+
+        def render():
+            form = BlockForm(instance=Block.objects.get(pk=block.pk))
+            return template.render(Context({"form": form, "csrf_token": "a"}))
+
+        with override_settings(NEST_FRAGMENT_CACHE=True):
+            first = render()
+            Building.objects.update(name="Changed behind our back")
+            self.assertEqual(render(), first)
+
+            data = get_form_data(BlockForm(instance=block))
+            data["buildings-0-name"] = "Renamed"
+            form = BlockForm(data, instance=block)
+            self.assertTrue(form.is_valid())
+            form.save()
+            self.assertTrue("Renamed" in render())
+
+
+class TemplateBundleTest(TestCase):
+    def test_bundle_replaces_the_inline_templates(self):
+        """
+        Tests that the nested_form tag loads the template bundle instead of
+        printing the templates once there is one.
+        """
+        static_dir = tempfile.mkdtemp()
+        try:
+            filename, written = write_bundle(static_dir, [BlockForm])
+            self.assertTrue(written)
+            with open(filename) as f:
+                self.assertTrue('"TenantForm-template"' in f.read())
+            self.assertFalse(write_bundle(static_dir, [BlockForm])[1])
+
+            template = Template("{% load nested_crispy %}"
+                "{% nested_form form %}{% nested_form form %}")
+            manifest = os.path.join(static_dir, "js", "nest-templates.json")
+            with override_settings(NEST_TEMPLATE_BUNDLE=manifest):
+                html = template.render(Context({"form": BlockForm(),
+                    "csrf_token": "a"}))
+            self.assertEqual(html.count('<script src="/static/js/'
+                'nest-templates.'), 1)
+            self.assertFalse('type="text/html"' in html)
+        finally:
+            shutil.rmtree(static_dir)
+
+    def test_bundle_written_later_is_picked_up(self):
+        """
+        Tests that a bundle built after the first page was rendered is used
+        without restarting the process.
+        """
+        static_dir = tempfile.mkdtemp()
+        try:
+            template = Template("{% load nested_crispy %}{% nested_form form %}")
+            manifest = os.path.join(static_dir, "js", "nest-templates.json")
+            with override_settings(NEST_TEMPLATE_BUNDLE=manifest):
+                html = template.render(Context({"form": BlockForm()}))
+                self.assertTrue('type="text/html"' in html)
+                write_bundle(static_dir, [BlockForm])
+                html = template.render(Context({"form": BlockForm()}))
+            self.assertFalse('type="text/html"' in html)
+        finally:
+            shutil.rmtree(static_dir)
+
+
+class IterativeRenderTest(TestCase):
+    def test_same_markup(self):
+        """
+        Tests that the iterative renderer gives the exact same markup as the
+        recursive one.
+        """
+        block = create_block(buildings=2, tenants=2, furniture=1)
+        template = Template("{% load nested_crispy %}{% nested_form form %}")
+
+        def render():
+            form = BlockForm(instance=block)
+            return template.render(Context({"form": form, "csrf_token": "a"}))
+
+        recursive = render()
+        with override_settings(NEST_ITERATIVE_RENDER=True):
+            iterative = render()
+        self.assertEqual(recursive, iterative)
+
+
+class StreamingResponseTest(TestCase):
+    def test_streamed_page_is_the_same(self):
+        """
+        Tests that streaming the edit page gives the same page.
+        """
+        block = create_block(buildings=2, tenants=2, furniture=1)
+        url = "/edit/block/%s/" % block.pk
+        content = self.client.get(url).content
+        with override_settings(NEST_STREAM_RESPONSES=True):
+            response = self.client.get(url)
+        self.assertTrue(response.streaming)
+        streamed = b"".join(response.streaming_content)
+        self.assertFalse(b"nest-stream" in streamed)
+        self.assertEqual(content, streamed)
+
+
+class ChildWindowTest(TestCase):
+    def test_first_page_of_children(self):
+        """
+        Tests that only the first child_limit children get a form and that
+        the rest can be fetched from the child-forms view.
+        """
+        block = create_block(buildings=3, tenants=1, furniture=1)
+        form = BlockForm(instance=block, child_limit=2)
+        self.assertEqual(len(form.inline_form.forms), 2)
+        self.assertTrue(form.inline_form.has_more)
+
+        response = self.client.get("/children/block/%s/" % block.pk,
+            {"offset": 2, "limit": 2})
+        data = json.loads(response.content.decode("utf-8"))
+        self.assertEqual(data["count"], 1)
+        self.assertFalse(data["hasMore"])
+
+
+class NestedFormJsTest(TestCase):
+    def test_bindings_are_data(self):
+        """
+        Tests that the management forms are bound by one loop over a JSON
+        array instead of one statement per formset.
+        """
+        block = create_block(buildings=2, tenants=2, furniture=1)
+        form = BlockForm(instance=block)
+        template = Template("{% load nested_crispy %}{% nested_form_js form %}")
+        html = template.render(Context({"form": form}))
+        self.assertEqual(html.count("applyManagementForms("), 1)
+        self.assertFalse("ko.applyBindings" in html)
+        start = html.index("applyManagementForms(") + len("applyManagementForms(")
+        bindings = json.loads(html[start:html.index(");", start)])
+        # the block, its 2 buildings and their 4 tenants
+        self.assertEqual(len(bindings), 7)
+        self.assertEqual(bindings[0][2], 2)
@@ -0,0 +1,193 @@
+""" Tracing of where the time of nested forms goes.
+
+	While a Tracer is active (see TracingMiddleware for one per request)
+	the nested forms record a span for every form they construct, render,
+	validate and save. The tracer adds them up per operation, level and
+	form class:
+	- calls: the number of spans
+	- time/queries: the wall time and queries of the spans, including the
+	  nested forms they worked on
+	- self_time/self_queries: the same without the nested forms
+	- rows: the child rows the spans worked on
+
+	When no tracer is active, span() hands out a shared no-op span so
+	tracing costs next to nothing.
+
+	    with Tracer() as tracer:
+	        form = BlockForm(instance=block)
+	    tracer.report()
+
+	The trace_finished signal is sent with the tracer whenever one
+	finishes, which is the place to hook up anything else.
+"""
+import threading
+import time
+
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.dispatch import Signal
+
+timer = getattr(time, "perf_counter", time.time)
+
+trace_finished = Signal(providing_args=["tracer"])
+
+_local = threading.local()
+_lock = threading.Lock()
+
+""" The number of tracers active in any thread, when it is 0 we don't even
+	look for the tracer of the current thread.
+"""
+active_tracers = 0
+
+
+def get_level(obj):
+	""" Returns how deep the given form or formset is nested, judging by
+		its prefix (e.g. 2 for buildings-0-tenants-1).
+	"""
+	prefix = getattr(obj, "prefix", None)
+	if not prefix:
+		return 0
+	return (prefix.count("-") + 2) // 2
+
+def get_tracer():
+	""" Returns the active tracer of this thread, if any.
+	"""
+	if not active_tracers:
+		return None
+	return getattr(_local, "tracer", None)
+
+def span(operation, obj):
+	""" Returns the span to record the given operation on the given form
+		or formset with, e.g.
+
+		    with tracing.span("validate", self) as span:
+		        ...
+		        span.rows = len(formset.forms)
+	"""
+	tracer = get_tracer()
+	if tracer is None:
+		return NULL_SPAN
+	return Span(tracer, operation, obj)
+
+
+class NullSpan(object):
+	""" The span handed out when tracing is off, it records nothing.
+	"""
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		return False
+
+	def __setattr__(self, name, value):
+		pass
+
+NULL_SPAN = NullSpan()
+
+
+class Span(object):
+
+	def __init__(self, tracer, operation, obj):
+		self.tracer = tracer
+		self.operation = operation
+		self.obj = obj
+		self.rows = 0
+		self.child_time = 0
+		self.child_queries = 0
+
+	def __enter__(self):
+		self.tracer.stack.append(self)
+		self.queries = self.tracer.get_query_count()
+		self.start = timer()
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		elapsed = timer() - self.start
+		queries = self.tracer.get_query_count() - self.queries
+		stack = self.tracer.stack
+		stack.pop()
+		if stack:
+			stack[-1].child_time += elapsed
+			stack[-1].child_queries += queries
+		# The level and name are only known once the form is constructed
+		self.tracer.record(self.operation, get_level(self.obj),
+			self.obj.__class__.__name__, elapsed, elapsed - self.child_time,
+			queries, queries - self.child_queries, self.rows)
+		return False
+
+
+class Tracer(object):
+	""" Collects the spans recorded in this thread while it is active.
+	"""
+
+	def __init__(self, using=DEFAULT_DB_ALIAS, name=None):
+		self.connection = connections[using]
+		self.name = name
+		self.stack = []
+		self.stats = {}
+		self.previous = None
+
+	def __enter__(self):
+		global active_tracers
+		connection = self.connection
+		self.use_debug_cursor = getattr(connection, "use_debug_cursor", None)
+		self.force_debug_cursor = getattr(connection, "force_debug_cursor", None)
+		connection.use_debug_cursor = True
+		connection.force_debug_cursor = True
+		self.previous = getattr(_local, "tracer", None)
+		_local.tracer = self
+		with _lock:
+			active_tracers += 1
+		self.start = timer()
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		global active_tracers
+		self.time = timer() - self.start
+		with _lock:
+			active_tracers -= 1
+		_local.tracer = self.previous
+		self.connection.use_debug_cursor = self.use_debug_cursor
+		self.connection.force_debug_cursor = self.force_debug_cursor
+		trace_finished.send(sender=self.__class__, tracer=self)
+		return False
+
+	def get_query_count(self):
+		return len(self.connection.queries)
+
+	def record(self, operation, level, form, time, self_time, queries,
+			self_queries, rows):
+		key = (operation, level, form)
+		stats = self.stats.get(key)
+		if stats is None:
+			stats = self.stats[key] = {"calls": 0, "time": 0, "self_time": 0,
+				"queries": 0, "self_queries": 0, "rows": 0}
+		stats["calls"] += 1
+		stats["time"] += time
+		stats["self_time"] += self_time
+		stats["queries"] += queries
+		stats["self_queries"] += self_queries
+		stats["rows"] += rows
+
+	def report(self):
+		""" Returns the stats per operation, level and form class
+		"""
+		report = []
+		for (operation, level, form), stats in sorted(self.stats.items()):
+			row = {"operation": operation, "level": level, "form": form}
+			row.update(stats)
+			report.append(row)
+		return report
+
+	def summary(self):
+		""" Returns the totals per operation: the time and queries spent on
+			it (without double counting nested spans) and its rows.
+		"""
+		summary = {}
+		for (operation, level, form), stats in self.stats.items():
+			totals = summary.setdefault(operation,
+				{"time": 0, "queries": 0, "rows": 0})
+			totals["time"] += stats["self_time"]
+			totals["queries"] += stats["self_queries"]
+			totals["rows"] += stats["rows"]
+		return summary
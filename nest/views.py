@@ -1,7 +1,11 @@
+import json
+
 from django.shortcuts import render_to_response, get_object_or_404, redirect
-from django.http import HttpResponse
+from django.http import (HttpResponse, Http404, HttpResponseBadRequest,
+	HttpResponseNotAllowed)
 from django.template import RequestContext
 from django.core.urlresolvers import reverse
+from django.conf import settings
 
 from crispy_forms.helper import FormHelper
 
@@ -11,9 +15,16 @@ from nest.forms import (BuildingFormSet,
 	TenantForm,
 	FurnitureForm,
 	InlineFormset,
-	nested_formset_factory
+	nested_formset_factory,
+	get_lineage
 	)
 from nest.models import Block, Building, Tenant, Furniture
+from nest.bulk import delete_trees
+from nest.cache import bump_versions
+from nest.jobs import submit_save, get_job
+from nest.listing import get_hierarchy, get_hierarchy_page
+from nest.streaming import render_to_streaming_response
+from nest.templatetags.nested_crispy import render_child_forms, get_binding_data
 
 model_maps = {
 	"block" : Block,
@@ -29,42 +40,161 @@ form_maps = {
 	"furniture" : FurnitureForm
 }
 
+def render_form_page(request, template_name, dictionary):
+	""" Renders a page holding a nested form. The nested form is streamed
+		out as it is rendered when NEST_STREAM_RESPONSES is set.
+	"""
+	if getattr(settings, "NEST_STREAM_RESPONSES", False):
+		return render_to_streaming_response(request, template_name, dictionary)
+	return render_to_response(template_name, dictionary,
+		context_instance=RequestContext(request))
+
+def get_blocks_page(request):
+	""" Returns the page of blocks (with their whole trees) to list
+	"""
+	return get_hierarchy_page(BlockForm, request.GET.get("page", 1))
+
 def home(request):
-	blocks = Block.objects.all()
+	page = get_blocks_page(request)
+	blocks = page.object_list
 	return render_to_response("form.html", locals(), 
 		context_instance=RequestContext(request))
 
+def get_form_kwargs(request):
+	""" Returns the data to bind the nested form of the request with: the
+		POSTed fields or the decoded tree of a JSON submission (see
+		submitNestedForm in forms.js). Raises ValueError for bad JSON.
+	"""
+	if request.method != "POST":
+		return {}
+	if request.META.get("CONTENT_TYPE", "").startswith("application/json"):
+		return {"json_data": json.loads(request.body.decode("utf-8"))}
+	return {"data": request.POST or None}
+
+def queue_save(form):
+	""" Saves the validated form in the background (see nest.jobs) and
+		answers with the id of the job and where to follow it.
+	"""
+	job_id = submit_save(form)
+	data = {
+		"job": job_id,
+		"status": reverse("job-status", kwargs=dict(job_id=job_id)),
+	}
+	return HttpResponse(json.dumps(data), content_type="application/json",
+		status=202)
+
 def new_block(request):
-	form = BlockForm(request.POST or None)
+	try:
+		form = BlockForm(**get_form_kwargs(request))
+	except ValueError as e:
+		return HttpResponseBadRequest("Bad JSON submission: %s" % e)
 	if form.is_valid():
+		if getattr(settings, "NEST_BACKGROUND_SAVE", False):
+			return queue_save(form)
 		form.save()
 		return redirect("/")
-	return render_to_response("new_form.html", locals(), 
-		context_instance=RequestContext(request))
+	return render_form_page(request, "new_form.html", locals())
 
 def edit_model(request, model, pk):
-	blocks = Block.objects.all()
 	if model not in model_maps:
 		raise Http404("Huh?!?!?")
 	model_class = model_maps.get(model)
 	form_class = form_maps.get(model)
-	obj = get_object_or_404(model_class, pk=pk)
-	form = form_class(request.POST or None, instance=obj)
-	if form.is_bound and form.is_valid():
-		form.save()
+	rows = get_hierarchy(form_class,
+		model_class._default_manager.filter(pk=pk))
+	if not rows:
+		raise Http404("No %s %s" % (model, pk))
+	obj = rows[0]
+	try:
+		form = form_class(instance=obj, **get_form_kwargs(request))
+	except ValueError as e:
+		return HttpResponseBadRequest("Bad JSON submission: %s" % e)
+	# Only the rows that were edited need to be validated and saved
+	if form.is_bound and form.is_valid(changed_only=True):
+		if getattr(settings, "NEST_BACKGROUND_SAVE", False):
+			return queue_save(form)
+		form.save(changed_only=True)
 		return redirect(reverse("edit-model", kwargs=dict(model=model, pk=pk)))
 
-	return render_to_response("form.html", locals(), 
-		context_instance=RequestContext(request))
+	# The listing is only needed when the page is rendered
+	page = get_blocks_page(request)
+	blocks = page.object_list
+	return render_form_page(request, "form.html", locals())
 
 def delete_model(request, model, pk):
 	if model not in model_maps:
 		raise Http404("Huh?!?!?")
 	model_class = model_maps.get(model)
 	obj = get_object_or_404(model_class, pk=pk)
-	obj.delete()
+	if getattr(settings, "NEST_FRAGMENT_CACHE", False):
+		bump_versions(get_lineage(obj))
+	delete_trees(form_maps[model], [obj.pk])
 	return redirect("/")
 
+def delete_models(request, model):
+	""" Deletes the rows with the pks POSTed (as pk, many times) along with
+		their trees of children, or detaches their children when detach is
+		POSTed, and returns the counts of the rows per model as JSON.
+	"""
+	if model not in form_maps:
+		raise Http404("Huh?!?!?")
+	if request.method != "POST":
+		return HttpResponseNotAllowed(["POST"])
+	try:
+		pks = [int(pk) for pk in request.POST.getlist("pk")]
+	except ValueError:
+		return HttpResponseBadRequest("Bad pk")
+	if getattr(settings, "NEST_FRAGMENT_CACHE", False):
+		rows = set()
+		for obj in model_maps[model]._default_manager.filter(pk__in=pks):
+			rows.update(get_lineage(obj))
+		bump_versions(rows)
+	counts = delete_trees(form_maps[model], pks,
+		detach=bool(request.POST.get("detach")))
+	return HttpResponse(json.dumps(counts), content_type="application/json")
+
+def child_forms(request, model, pk):
+	""" Returns the next page of children of the given object as JSON. This
+		is what the "Load more" button of forms that only show the first
+		few children (see NestedModelForm.child_limit) asks for.
+	"""
+	if model not in model_maps or model not in form_maps:
+		raise Http404("Huh?!?!?")
+	model_class = model_maps.get(model)
+	form_class = form_maps.get(model)
+	obj = get_object_or_404(model_class, pk=pk)
+	try:
+		offset = int(request.GET.get("offset", 0))
+		limit = int(request.GET.get("limit",
+			getattr(settings, "NEST_CHILD_LIMIT", None) or 20))
+	except ValueError:
+		raise Http404("Bad offset or limit")
+	form = form_class(instance=obj, prefix=request.GET.get("prefix", ""),
+		child_limit=limit, child_offset=offset)
+	formset = getattr(form, "inline_form", None)
+	if formset is None:
+		raise Http404("%s has no children" % model)
+
+	bindings = []
+	for child_form in formset.forms:
+		bindings.extend(get_binding_data(child_form))
+	data = {
+		"html": render_child_forms(formset, RequestContext(request)),
+		"count": len(formset.forms),
+		"hasMore": formset.has_more,
+		"bindings": bindings,
+	}
+	return HttpResponse(json.dumps(data), content_type="application/json")
+
+def job_status(request, job_id):
+	""" Returns the state of a background save (see nest.jobs.get_job) as
+		JSON.
+	"""
+	job = get_job(job_id)
+	if job is None:
+		raise Http404("No such job")
+	return HttpResponse(json.dumps(job), content_type="application/json")
+
 def testing(request):
 	return render_to_response("testing.html")
 	
\ No newline at end of file
@@ -70,6 +70,11 @@ STATIC_ROOT = ''
 # Example: "http://example.com/static/", "http://static.example.com/"
 STATIC_URL = '/static/'
 
+# The manifest of the bundle of knockout templates written by the
+# form_templates command, see nest.bundle. Off by default, to use it set
+# it to os.path.join(PROJECT_ROOT, "static", "js", "nest-templates.json")
+NEST_TEMPLATE_BUNDLE = None
+
 # Additional locations of static files
 STATICFILES_DIRS = (
     # Put strings here, like "/home/html/static" or "C:/www/django/static".
@@ -102,6 +107,8 @@ MIDDLEWARE_CLASSES = (
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
+    # Traces the nested forms of every request when NEST_TRACING is True
+    'nest.middleware.TracingMiddleware',
     # Uncomment the next line for simple clickjacking protection:
     # 'django.middleware.clickjacking.XFrameOptionsMiddleware',
 )
@@ -4,11 +4,18 @@ from django.conf.urls import patterns, include, url
 # from django.contrib import admin
 # admin.autodiscover()
 
+# Build all the nested formset classes once, up front
+from nest.forms import warm_formset_registry
+warm_formset_registry()
+
 urlpatterns = patterns('',
     # Examples:
     url(r'^$', 'nest.views.home', name='home'),
 	url(r'^edit/(?P<model>\w+)/(?P<pk>\d+)/$', 'nest.views.edit_model', name='edit-model'),
 	url(r'^delete/(?P<model>\w+)/(?P<pk>\d+)/$', 'nest.views.delete_model', name='delete-model'),
+	url(r'^delete/(?P<model>\w+)/$', 'nest.views.delete_models', name='delete-models'),
+	url(r'^children/(?P<model>\w+)/(?P<pk>\d+)/$', 'nest.views.child_forms', name='child-forms'),
+	url(r'^jobs/(?P<job_id>\w+)/$', 'nest.views.job_status', name='job-status'),
     url(r'^new-block/$', 'nest.views.new_block', name='new-block'),
     url(r'^testing/$', 'nest.views.testing', name='testing'),
 
@@ -48,6 +48,17 @@ function updateTemplateJs(){
   });
 }
 
+/**
+ * Recompiles the one template that was created or changed (the
+ * form_templates command only rewrites the templates that changed)
+ */
+function onTemplateChanged(path, curr, prev) {
+  var file = path.split("/").pop();
+  if(file.indexOf(fileExt) > -1 && file.indexOf("#") == -1){
+    recompileTemplate(file);
+  }
+}
+
 function recompileTemplates(path, curr, prev) {
   dust = require('dustjs-linkedin'); // reset dust
   fs.readdir(folder, function(err, files){
@@ -66,8 +77,8 @@ function recompileTemplates(path, curr, prev) {
 watch.createMonitor(folder, function (monitor) {
   console.log("[DUST] Watching " + folder + " to update " + templateJs);
   monitor.files["*" + fileExt, '*/*'];
-  monitor.on("created", recompileTemplates);
-  monitor.on("changed", recompileTemplates);
+  monitor.on("created", onTemplateChanged);
+  monitor.on("changed", onTemplateChanged);
 });
 
 // Recompile the templates
@@ -33,8 +33,10 @@
  * @param {String} childTemplate  - the name of the child (template) that will be added
  * @param {String} initialForms   - the number of child forms at start
  * @param {String} prefix         - the prefix for the management form 
+ * @param {Boolean} hasMore       - whether more (existing) children can be 
+ *                                  loaded from the server, see loadMore
  */
-function ManagementForm(parentFormName, childTemplate, initialForms, childPrefix){
+function ManagementForm(parentFormName, childTemplate, initialForms, childPrefix, hasMore){
     // e.g. BlockForm-form, BuildinForm-template, x, buildings
     // e.g. BuildingForm-form-buildings-0, TenantForm-template, x, buildings-0-tenants
     console.log("Setup mgmt form: parentFormName=", parentFormName, 
@@ -50,6 +52,33 @@ function ManagementForm(parentFormName, childTemplate, initialForms, childPrefix
     self.totalForms = ko.observable(initialForms);
     self.maxForms = ko.observable(1000);
     self.initialForms = ko.observable(initialForms);
+    self.hasMore = ko.observable(hasMore || false);
+
+    // Existing children have to come before the new ones, so we can only
+    // load more of them as long as no new child was added
+    self.canLoadMore = ko.computed(function(){
+        return self.hasMore() && self.totalForms() == self.initialForms();
+    });
+
+    /**
+     * Loads the next page of existing children from the url in the 
+     * data-url of the button that was clicked and adds them after the 
+     * children we already have.
+     */
+    self.loadMore = function(data, event) {
+        if(!self.canLoadMore()){
+            console.log("Warning: can't load more children of " + self.parentFormName);
+            return;
+        }
+        var url = jQuery(event.target).attr("data-url");
+        jQuery.getJSON(url, {offset: self.initialForms()}, function(response){
+            jQuery(response.html).appendTo(jQuery("#" + self.childrenDivFormName));
+            self.initialForms(self.initialForms() + response.count);
+            self.totalForms(self.totalForms() + response.count);
+            self.hasMore(response.hasMore);
+            applyManagementForms(response.bindings);
+        });
+    };
 
     self.addChildForm = function() {
         console.log("Adding child " + this.childTemplate + " to " + this.childrenDivFormName + " with childPrefix: " + this.childPrefix, " parent is: ", this.parentFormName);
@@ -86,6 +115,21 @@ function ManagementForm(parentFormName, childTemplate, initialForms, childPrefix
     };
 }
 
+/**
+ * Applies the bindings for a list of management forms. Each binding holds 
+ * [parentFormName, childTemplate, initialForms, childPrefix, 
+ *  managementFormDivId, hasMore]
+ * @param {Array} bindings
+ */
+function applyManagementForms(bindings){
+    for(var i = 0; i < bindings.length; i++){
+        var binding = bindings[i];
+        var managementForm = new ManagementForm(binding[0], binding[1], 
+            binding[2], binding[3], binding[5]);
+        ko.applyBindings(managementForm, jQuery("#" + binding[4]).get()[0]);
+    }
+}
+
 /**
  * Returns the name of the child template given the name of the form class (parent)
  * @param  {String} parentForm 
@@ -133,3 +177,85 @@ function deleteChild(inp){
 }
 
 
+
+/**
+ * Turns the fields of a nested form into the tree that the JSON submission
+ * (see get_json_form_data in nest/forms.py) takes, e.g. the fields 
+ * name and buildings-0-tenants-1-first_name become 
+ * {name: ..., buildings: [{tenants: [undefined, {first_name: ...}]}]}
+ * The management forms are left out, the server works them out from the 
+ * lists of rows.
+ * @param  {Element} form - the form element
+ * @return {Object} - the tree
+ */
+function serializeNestedForm(form){
+    var tree = {};
+    jQuery.each(jQuery(form).serializeArray(), function(i, field){
+        var parts = field.name.split("-");
+        var name = parts.pop();
+        if(name == "csrfmiddlewaretoken" || /_FORMS$/.test(name) || parts.length % 2){
+            return;
+        }
+        var node = tree;
+        for(var j = 0; j < parts.length; j += 2){
+            var rows = node[parts[j]] = node[parts[j]] || [];
+            node = rows[parts[j + 1]] = rows[parts[j + 1]] || {};
+        }
+        if(node.hasOwnProperty(name)){ // e.g. a multiple select
+            node[name] = [].concat(node[name], field.value);
+        } else {
+            node[name] = field.value;
+        }
+    });
+    return tree;
+}
+
+/**
+ * Posts a nested form as one JSON document instead of the flat prefixed 
+ * fields and shows the page that comes back.
+ * @param {Element} form - the form element
+ */
+function submitNestedForm(form){
+    jQuery.ajax({
+        url: jQuery(form).attr("action") || window.location.href,
+        type: "POST",
+        contentType: "application/json",
+        data: JSON.stringify(serializeNestedForm(form)),
+        headers: {"X-CSRFToken": jQuery(form).find("[name=csrfmiddlewaretoken]").val()},
+        success: function(response, status, xhr){
+            if(xhr.status == 202){ // saving in the background
+                waitForJob(response.status, jQuery(form).attr("data-done-url"));
+                return;
+            }
+            document.open();
+            document.write(response);
+            document.close();
+        }
+    }).fail(function(xhr){
+        alert("Saving failed: " + (xhr.responseText || xhr.statusText));
+    });
+}
+
+/**
+ * Polls the status of a background save until it is done and then goes to 
+ * the given url (or reloads the page).
+ * @param {String} statusUrl - the url of the status of the job
+ * @param {String} doneUrl   - where to go once the job is done
+ */
+function waitForJob(statusUrl, doneUrl){
+    jQuery.getJSON(statusUrl, function(job){
+        if(job.status == "done"){
+            window.location.href = doneUrl || window.location.href;
+        } else if(job.status == "failed"){
+            alert("Saving failed: " + job.error);
+        } else {
+            setTimeout(function(){ waitForJob(statusUrl, doneUrl); }, 1000);
+        }
+    });
+}
+
+// Forms with data-submit="json" are posted with submitNestedForm
+jQuery(document).on("submit", "form[data-submit=json]", function(event){
+    event.preventDefault();
+    submitNestedForm(this);
+});